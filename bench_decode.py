@@ -0,0 +1,98 @@
+import resource
+import time
+from io import BytesIO
+from multiprocessing import get_context
+
+from PIL import Image
+
+from shared_logic import decode_source_image, RENDER_MAX_SIZE
+
+# (ширина, высота, формат) - типичные размеры large/largeImageURL и сырых мемов
+SAMPLES = [
+    (1280, 853, 'JPEG'),
+    (1920, 1280, 'JPEG'),
+    (4000, 2667, 'JPEG'),
+    (6000, 4000, 'JPEG'),
+    (3000, 2000, 'PNG'),
+]
+REPEATS = 5
+
+
+def make_sample(width, height, fmt):
+    """Картинка с градиентом и шумом, чтобы кодек не отделался пустыми блоками"""
+    img = Image.merge('RGB', (
+        Image.linear_gradient('L').resize((width, height)),
+        Image.effect_noise((width, height), 12),
+        Image.linear_gradient('L').rotate(90).resize((width, height)),
+    ))
+    output = BytesIO()
+    img.save(output, format=fmt, quality=90)
+    return output.getvalue()
+
+
+def legacy_decode(data, max_size=RENDER_MAX_SIZE):
+    """Старая загрузка: полное декодирование, convert и только потом thumbnail"""
+    img = Image.open(BytesIO(data)).convert('RGB')
+    if img.width > max_size or img.height > max_size:
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    return img
+
+
+def _rss_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return 0
+
+
+def _measure(decode, data, conn):
+    # Pillow выделяет память под пиксели мимо tracemalloc - смотрим пик RSS процесса.
+    # Пик, унаследованный от родителя, сбрасываем (Linux: clear_refs 5)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        before = _rss_kb('VmRSS:')
+    except OSError:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    img = decode(data)
+    elapsed = time.perf_counter() - start
+    peak = _rss_kb('VmHWM:') or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn.send((elapsed, peak - before, img.size))
+    conn.close()
+
+
+def measure(decode, data):
+    """Время и прирост пика памяти (КБ) одного декодирования в чистом дочернем процессе"""
+    ctx = get_context('fork')
+    parent, child = ctx.Pipe()
+    process = ctx.Process(target=_measure, args=(decode, data, child))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def bench_decode():
+    print("=" * 50)
+    print(f"⏱️ БЕНЧМАРК ДЕКОДИРОВАНИЯ: до {RENDER_MAX_SIZE} px, {REPEATS} повторов")
+    print("=" * 50)
+
+    for width, height, fmt in SAMPLES:
+        data = make_sample(width, height, fmt)
+        rows = {}
+        for name, decode in (('старое', legacy_decode), ('новое', decode_source_image)):
+            runs = [measure(decode, data) for _ in range(REPEATS)]
+            elapsed = sorted(run[0] for run in runs)[REPEATS // 2]
+            peak = max(run[1] for run in runs)
+            rows[name] = (elapsed, peak, runs[0][2])
+
+        old, new = rows['старое'], rows['новое']
+        print(f"🖼️ {fmt} {width}x{height} ({len(data) // 1024} КБ) -> {new[2][0]}x{new[2][1]}")
+        print(f"   🐢 Старое: {old[0] * 1000:7.1f} мс, пик +{old[1] / 1024:6.1f} МБ")
+        print(f"   🚀 Новое:  {new[0] * 1000:7.1f} мс, пик +{new[1] / 1024:6.1f} МБ  x{old[0] / new[0]:.1f}")
+
+
+if __name__ == '__main__':
+    bench_decode()
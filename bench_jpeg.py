@@ -0,0 +1,70 @@
+import math
+import time
+from io import BytesIO
+
+from PIL import Image, ImageChops, ImageStat
+
+from jpeg_encoder import encode_jpeg, JPEG_TARGET_BYTES
+from text_layout import layout_caption, draw_caption
+
+REPEATS = 5
+# (название, профиль, доп. параметры encode_jpeg)
+VARIANTS = [
+    ('fast', 'fast', {}),
+    ('balanced', 'balanced', {}),
+    ('size', 'size', {}),
+    ('size + progressive', 'size', {'progressive': True}),
+    ('size 4:4:4', 'size', {'subsampling': '4:4:4'}),
+]
+
+
+def make_samples():
+    """Типичные рендеры 1200 px: «фото» с шумом, плоская картинка-мем и градиент, все с подписью"""
+    size = (1200, 800)
+    photo = Image.merge('RGB', (
+        Image.linear_gradient('L').resize(size),
+        Image.effect_noise(size, 24),
+        Image.linear_gradient('L').rotate(90).resize(size),
+    ))
+    flat = Image.new('RGB', size, (40, 90, 200))
+    flat.paste((250, 220, 40), (100, 100, 500, 400))
+    gradient = Image.merge('RGB', (
+        Image.radial_gradient('L').resize(size),
+        Image.linear_gradient('L').resize(size),
+        Image.radial_gradient('L').rotate(45).resize(size),
+    ))
+
+    samples = []
+    for name, img in (('фото', photo), ('плоская', flat), ('градиент', gradient)):
+        draw_caption(img, layout_caption("Когда понял, что уже пятница", img.width, img.height))
+        samples.append((name, img))
+    return samples
+
+
+def psnr(original, data):
+    """PSNR в дБ между исходником и раскодированным JPEG"""
+    decoded = Image.open(BytesIO(data)).convert('RGB')
+    diff = ImageChops.difference(original, decoded)
+    mse = sum(value ** 2 for value in ImageStat.Stat(diff).rms) / 3
+    return float('inf') if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def bench_jpeg():
+    print("=" * 50)
+    print(f"⏱️ БЕНЧМАРК JPEG: цель size - {JPEG_TARGET_BYTES // 1024} КБ, {REPEATS} повторов")
+    print("=" * 50)
+
+    for sample_name, img in make_samples():
+        print(f"🖼️ {sample_name} {img.width}x{img.height}")
+        for name, profile, options in VARIANTS:
+            timings = []
+            for _ in range(REPEATS):
+                start = time.perf_counter()
+                data = encode_jpeg(img, profile=profile, **options)
+                timings.append(time.perf_counter() - start)
+            elapsed = sorted(timings)[REPEATS // 2]
+            print(f"   {name:<20} {elapsed * 1000:7.1f} мс  {len(data) / 1024:7.1f} КБ  PSNR {psnr(img, data):5.1f} дБ")
+
+
+if __name__ == '__main__':
+    bench_jpeg()
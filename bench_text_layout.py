@@ -0,0 +1,95 @@
+import json
+import time
+
+from PIL import Image, ImageDraw
+
+from fonts import get_base_font, get_font, text_advance, text_bbox
+from text_layout import CAPTION_SIZES, layout_caption
+
+WIDTHS = [1200, 800, 480]
+
+
+def load_bench_phrases():
+    with open('phrases.json', 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return [phrase for phrases in data.values() for phrase in phrases]
+
+
+def legacy_layout(text, width, draw, base_font):
+    """Старая раскладка: линейный перебор размеров и перемер каждой строки"""
+    side_margin = min(max(int(width * 0.05), 20), 60)
+    target_width = width - (side_margin * 2)
+    # Выборка символов как в text_layout, чтобы сравнивать только алгоритм
+    unique_chars = ''.join(dict.fromkeys(text.replace(' ', ''))) or "А"
+    char_width_target = (target_width / len(text)) * 0.93
+
+    optimal_font_size = 20
+    for size in CAPTION_SIZES:
+        font = base_font.font_variant(size=size)
+        total_width = 0
+        for char in unique_chars[:5]:
+            bbox = draw.textbbox((0, 0), char, font=font)
+            total_width += bbox[2] - bbox[0]
+        if total_width / min(len(unique_chars), 5) <= char_width_target:
+            optimal_font_size = size
+            break
+
+    font = base_font.font_variant(size=optimal_font_size)
+    lines = []
+    current_line = []
+    for word in text.split():
+        test_line = ' '.join(current_line + [word])
+        bbox = draw.textbbox((0, 0), test_line, font=font)
+        if bbox[2] - bbox[0] <= target_width:
+            current_line.append(word)
+        else:
+            if current_line:
+                lines.append(' '.join(current_line))
+            current_line = [word]
+    if current_line:
+        lines.append(' '.join(current_line))
+    return optimal_font_size, lines
+
+
+def clear_caches():
+    for cached in (get_font, text_bbox, text_advance):
+        cached.cache_clear()
+
+
+def bench_layout():
+    """Сравнивает старую и новую раскладку подписи на фразах из phrases.json"""
+    phrases = load_bench_phrases()
+    base_font = get_base_font()
+    draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+
+    print("=" * 50)
+    print(f"⏱️ БЕНЧМАРК РАСКЛАДКИ: {len(phrases)} фраз x {len(WIDTHS)} ширины")
+    print("=" * 50)
+
+    start = time.perf_counter()
+    legacy = [legacy_layout(phrase, width, draw, base_font) for width in WIDTHS for phrase in phrases]
+    legacy_time = time.perf_counter() - start
+
+    clear_caches()
+    start = time.perf_counter()
+    for width in WIDTHS:
+        for phrase in phrases:
+            layout_caption(phrase, width, width)
+    cold_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    current = [layout_caption(phrase, width, width) for width in WIDTHS for phrase in phrases]
+    warm_time = time.perf_counter() - start
+
+    same_size = sum(1 for old, new in zip(legacy, current) if old[0] == new.font_size)
+    same_lines = sum(1 for old, new in zip(legacy, current) if old[1] == new.lines)
+    total = len(legacy)
+
+    print(f"🐢 Старая раскладка:      {legacy_time * 1000:8.1f} мс")
+    print(f"🧊 Новая (холодный кэш): {cold_time * 1000:8.1f} мс  x{legacy_time / cold_time:.1f}")
+    print(f"🔥 Новая (тёплый кэш):   {warm_time * 1000:8.1f} мс  x{legacy_time / warm_time:.1f}")
+    print(f"🎯 Совпал размер шрифта: {same_size}/{total}, совпали строки: {same_lines}/{total}")
+
+
+if __name__ == '__main__':
+    bench_layout()
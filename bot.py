@@ -1,7 +1,7 @@
 import os
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent, ReplyKeyboardMarkup, KeyboardButton
-from flask import Flask, request, abort, send_file
+from flask import Flask, request, abort, send_file, jsonify
 from dotenv import load_dotenv
 import time
 import threading
@@ -19,6 +19,15 @@ import pytz
 
 # Импортируем общую логику
 from shared_logic import *
+from menu_pool import MenuPool
+from image_store import create_image_store
+from update_queue import KeyedWorkQueue
+from concurrent.futures import Future
+from inline_tracker import InlineTracker, QuerySuperseded
+from inline_intents import (parse_inline_query, telegram_cache_policy, InlineResultCache,
+                            CandidateSessions, session_key, next_offset, parse_offset,
+                            INLINE_PAGE_SIZE)
+from jpeg_encoder import jpeg_settings
 
 load_dotenv()
 
@@ -39,8 +48,12 @@ app = Flask(__name__)
 
 # ========== ОБЩИЕ ПЕРЕМЕННЫЕ ==========
 current_api_index = 0
-temp_images = {}
+temp_images = create_image_store()
 user_states = {}  # Для диалогов в личных сообщениях
+menu_pool = MenuPool()
+inline_tracker = InlineTracker()
+inline_results = InlineResultCache()
+candidate_sessions = CandidateSessions()
 
 # ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
 def generate_unique_id(prefix="img"):
@@ -49,17 +62,132 @@ def generate_unique_id(prefix="img"):
     unique_str = str(uuid.uuid4()).replace('-', '')[:8]
     return f"{prefix}_{timestamp}_{random_part}_{unique_str}"
 
+def generate_render_id(kind, source_url, text, **params):
+    """Id рендера по содержимому: одинаковые входные данные и параметры вывода дают тот же id"""
+    # Размер вывода - часть идентичности: смена THUMB_SIZE даёт новые id, а не старые картинки
+    params = {'size': render_size(kind), **params}
+    # Подписанные картинки кодируются по JPEG_* - смена профиля тоже даёт новые id
+    if kind == 'img':
+        params.setdefault('jpeg', jpeg_settings())
+    key = json.dumps([RENDERER_VERSION, kind, source_url, text, params], ensure_ascii=False, sort_keys=True)
+    return f"{kind}_{hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]}"
+
+def render_size(kind):
+    return THUMB_SIZE if kind.endswith('_thumb') else RENDER_MAX_SIZE
+
+def render_bytes(kind, source_url, text):
+    """Рендерит картинку; возвращает (байты, content_type) или None
+
+    kind: img, gif или превьюшка к ним - img_thumb, gif_thumb (JPEG).
+    """
+    if kind.endswith('_thumb'):
+        content_type = 'image/jpeg'
+        full = make_thumbnail(kind[:-len('_thumb')], source_url, text)
+    elif kind == 'gif':
+        content_type = 'image/gif'
+        if text:
+            full = add_text_to_gif(source_url, text)
+        else:
+            full = BytesIO(source_gifs.get(source_url))
+    else:
+        content_type = 'image/jpeg'
+        full = add_text_to_image(source_url, text)
+    
+    if not full:
+        return None
+    return full.getvalue(), content_type
+
+def store_render(kind, source_url, text):
+    """Рендерит картинку сразу (или берёт уже готовую) и возвращает её id в хранилище"""
+    image_id = generate_render_id(kind, source_url, text)
+    if image_id in temp_images:
+        return image_id
+    
+    rendered = render_bytes(kind, source_url, text)
+    if not rendered:
+        return None
+    temp_images.put(image_id, *rendered)
+    return image_id
+
+def plan_render(kind, source_url, text):
+    """Сохраняет только рецепт рендера; сама картинка рисуется при первом GET /image/<id>"""
+    image_id = generate_render_id(kind, source_url, text)
+    if image_id not in temp_images:
+        temp_images.put_recipe(image_id, {
+            'kind': kind,
+            'source_url': source_url,
+            'text': text,
+            'renderer': RENDERER_VERSION,
+            'size': render_size(kind),
+        })
+    return image_id
+
+render_flights = {}
+render_flights_lock = threading.Lock()
+
+def render_from_recipe(image_id):
+    """Рендер по рецепту; одновременные запросы одного id ждут один общий рендер"""
+    with render_flights_lock:
+        future = render_flights.get(image_id)
+        owner = future is None
+        if owner:
+            future = render_flights[image_id] = Future()
+    if not owner:
+        return future.result()
+    
+    ok = False
+    busy = None
+    try:
+        recipe = temp_images.get_recipe(image_id)
+        if image_id in temp_images:
+            # Уже отрендерил другой воркер
+            ok = True
+        elif recipe and recipe.get('renderer') == RENDERER_VERSION and recipe.get('size') == render_size(recipe['kind']):
+            rendered = render_bytes(recipe['kind'], recipe['source_url'], recipe['text'])
+            ok = bool(rendered) and temp_images.put(image_id, *rendered)
+    except RenderBusy as e:
+        busy = e
+    except Exception as e:
+        print(f"❌ Ошибка рендера {image_id}: {e}")
+    finally:
+        if busy:
+            future.set_exception(busy)
+        else:
+            future.set_result(ok)
+        with render_flights_lock:
+            render_flights.pop(image_id, None)
+    if busy:
+        raise busy
+    return ok
+
 def cleanup_temp_images():
     while True:
-        time.sleep(600)
-        now = time.time()
-        to_delete = [k for k, (_, ts) in temp_images.items() if now - ts > 900]
-        for k in to_delete:
-            del temp_images[k]
-        if to_delete:
-            print(f"🧹 Очищено {len(to_delete)} старых файлов")
-
+        time.sleep(60)
+        purged = temp_images.purge_expired()
+        if purged:
+            print(f"🧹 Очищено {purged} старых файлов")
+
+def update_key(update):
+    """Ключ порядка: чат для сообщений, пользователь для inline и кнопок"""
+    if update.message:
+        return f"chat_{update.message.chat.id}"
+    for event in (update.inline_query, update.chosen_inline_result, update.callback_query):
+        if event:
+            return f"user_{event.from_user.id}"
+    return f"update_{update.update_id}"
+
+def process_update(update):
+    bot.process_new_updates([update])
+
+update_queue = KeyedWorkQueue(process_update)
+
+# Процессы рендера - до любых фоновых потоков
+render_service.start()
 threading.Thread(target=cleanup_temp_images, daemon=True).start()
+update_queue.start()
+menu_pool.start()
+image_harvester.start()
+meme_templates.start()
 
 # ========== ФУНКЦИИ ДЛЯ ЛИЧНЫХ СООБЩЕНИЙ ==========
 def create_main_keyboard():
@@ -99,10 +227,11 @@ def send_photo_with_text(chat_id, text, photo_type='photo', query=None, count=1)
                 url = get_random_gif(query)
                 if url:
                     if text:
-                        full = add_text_to_gif(url, text)
                         # Для GIF с текстом сохраняем во временное хранилище
-                        file_id = generate_unique_id("gif_temp")
-                        temp_images[file_id] = (full.getvalue(), time.time())
+                        file_id = store_render('gif', url, text)
+                        if not file_id:
+                            bot.send_message(chat_id, "❌ Не удалось наложить текст на GIF")
+                            continue
                         hostname = os.getenv("RAILWAY_PUBLIC_DOMAIN", "localhost")
                         gif_url = f"https://{hostname}/image/{file_id}"
                         
@@ -130,7 +259,7 @@ def send_photo_with_text(chat_id, text, photo_type='photo', query=None, count=1)
                     if text:
                         full = add_text_to_image(url, text)
                     else:
-                        r = requests.get(url, timeout=10)
+                        r = http_get(url, timeout=10)
                         full = BytesIO(r.content)
                     
                     if full:
@@ -143,7 +272,7 @@ def send_photo_with_text(chat_id, text, photo_type='photo', query=None, count=1)
                     if text:
                         full = add_text_to_image(url, text)
                     else:
-                        r = requests.get(url, timeout=10)
+                        r = http_get(url, timeout=10)
                         full = BytesIO(r.content)
                     
                     if full:
@@ -296,6 +425,40 @@ def handle_all_messages(message):
         bot.send_message(message.chat.id, "Используйте кнопки ниже 👇", reply_markup=create_main_keyboard())
 
 # ========== INLINE РЕЖИМ ==========
+MENU_HELP_TEXT = (
+    "📖 **Как пользоваться:**\n\n"
+    "**Основные команды:**\n"
+    "• `@randompikcha2_bot` - это меню\n"
+    "• `@randompikcha2_bot кот` - фото по теме\n"
+    "• `@randompikcha2_bot 3` - 3 фото на выбор\n\n"
+    "**Текст на фото:**\n"
+    "• `@randompikcha2_bot \"Привет\"` - фото с текстом\n"
+    "• `@randompikcha2_bot \"Привет\" кот 3` - 3 фото котов с текстом\n\n"
+    "**Случайные фразы:**\n"
+    "• `@randompikcha2_bot randtext` - фото с фразой\n\n"
+    "**Категории фраз:**\n" +
+    ''.join([f"• `@randompikcha2_bot {cat}`\n" for cat in PHRASES.keys()]) +
+    "\n**Мемы и GIF:**\n"
+    "• `@randompikcha2_bot meme` - случайный мем\n"
+    "• `@randompikcha2_bot gif` - случайная GIF\n\n"
+    "**Эмодзи дня:**\n"
+    "• `@randompikcha2_bot emoji` - твоё эмодзи на сегодня\n\n"
+    "⚡️ **Совет:** Добавляй число в конце для нескольких вариантов!"
+)
+
+MENU_HELP_RESULT = telebot.types.InlineQueryResultArticle(
+    id="menu_help",
+    title="📖 Инструкция",
+    description="Как пользоваться ботом",
+    input_message_content=telebot.types.InputTextMessageContent(
+        message_text=MENU_HELP_TEXT,
+        parse_mode='Markdown'
+    ),
+    thumbnail_url="https://images.unsplash.com/photo-1486312338219-ce68d2c6f44d?w=200",
+    thumbnail_width=200,
+    thumbnail_height=133
+)
+
 @bot.inline_handler(lambda query: True)
 def inline_handler(inline_query):
     query_text = inline_query.query.strip()
@@ -326,75 +489,71 @@ def inline_handler(inline_query):
         results.append(result5)
         print(f"  ✅ Эмодзи дня: {emoji}")
 
-        # Генерируем ОДНУ базовую картинку для всех вариантов
-        print(f"  ⏳ Генерируем базовую картинку...")
-        base_image_url, base_thumb_url = get_random_image()
-        if not base_image_url:
+        # Берём готовый набор из пула (или собираем на месте)
+        bundle = menu_pool.pop()
+        if not bundle:
             print(f"  ❌ Не удалось получить базовую картинку")
             return
         
-        print(f"  ✅ Базовая картинка получена: {base_image_url[:50]}...")
+        print(f"  ✅ Базовая картинка получена: {bundle['base_url'][:50]}...")
         
         # 1. Базовая картинка БЕЗ текста
         result1 = telebot.types.InlineQueryResultPhoto(
             id=generate_unique_id("menu_photo"),
-            photo_url=base_image_url,
-            thumbnail_url=base_thumb_url or base_image_url,
+            photo_url=bundle['base_url'],
+            thumbnail_url=bundle['base_thumb'],
             photo_width=1080,
             photo_height=720,
             title="🖼️ Базовая картинка",
             description="Исходное изображение"
         )
         results.append(result1)
-        print(f"  ✅ Базовая картинка без текста добавлена")
         
         # 2. Та же базовая картинка со случайной фразой
-        random_phrase = get_russian_phrase()
-        full = add_text_to_image(base_image_url, random_phrase)
-        if full:
-            image_id = generate_unique_id("menu_randtext")
-            temp_images[image_id] = (full.getvalue(), time.time())
+        if bundle['randtext']:
+            random_phrase, image_data = bundle['randtext']
+            image_id = generate_render_id('img', bundle['base_url'], random_phrase)
+            if image_id not in temp_images:
+                temp_images.put(image_id, image_data)
             hostname = os.getenv("RAILWAY_PUBLIC_DOMAIN", "localhost")
             url = f"https://{hostname}/image/{image_id}"
+            thumb_url = f"https://{hostname}/image/{plan_render('img_thumb', bundle['base_url'], random_phrase)}"
             
             result2 = telebot.types.InlineQueryResultPhoto(
                 id=image_id,
                 photo_url=url,
-                thumbnail_url=url,
+                thumbnail_url=thumb_url,
                 photo_width=1080,
                 photo_height=720,
                 title="🎲 Случайная фраза",
                 description=f"«{random_phrase[:40]}...»"
             )
             results.append(result2)
-            print(f"  ✅ Randtext добавлен")
         
         # 3. Та же базовая картинка со случайной категорией
-        if PHRASES:
-            random_category = random.choice(list(PHRASES.keys()))
-            random_phrase = get_random_phrase(random_category)
-            full = add_text_to_image(base_image_url, random_phrase)
-            if full:
-                image_id = generate_unique_id("menu_category")
-                temp_images[image_id] = (full.getvalue(), time.time())
-                hostname = os.getenv("RAILWAY_PUBLIC_DOMAIN", "localhost")
-                url = f"https://{hostname}/image/{image_id}"
-                
-                result3 = telebot.types.InlineQueryResultPhoto(
-                    id=image_id,
-                    photo_url=url,
-                    thumbnail_url=url,
-                    photo_width=1080,
-                    photo_height=720,
-                    title=f"🎭 {random_category.capitalize()}",
-                    description=f"«{random_phrase[:40]}...»"
-                )
-                results.append(result3)
-                print(f"  ✅ Категория {random_category} добавлена")
+        if bundle['category']:
+            random_category, random_phrase, image_data = bundle['category']
+            image_id = generate_render_id('img', bundle['base_url'], random_phrase)
+            if image_id not in temp_images:
+                temp_images.put(image_id, image_data)
+            hostname = os.getenv("RAILWAY_PUBLIC_DOMAIN", "localhost")
+            url = f"https://{hostname}/image/{image_id}"
+            thumb_url = f"https://{hostname}/image/{plan_render('img_thumb', bundle['base_url'], random_phrase)}"
+            
+            result3 = telebot.types.InlineQueryResultPhoto(
+                id=image_id,
+                photo_url=url,
+                thumbnail_url=thumb_url,
+                photo_width=1080,
+                photo_height=720,
+                title=f"🎭 {random_category.capitalize()}",
+                description=f"«{random_phrase[:40]}...»"
+            )
+            results.append(result3)
         
         # 4. Случайный мем
-        meme_url, thumb_url = get_random_meme()
-        if meme_url and thumb_url:
+        if bundle['meme']:
+            meme_url, thumb_url = bundle['meme']
             result4 = telebot.types.InlineQueryResultPhoto(
                 id=generate_unique_id("menu_meme"),
                 photo_url=meme_url,
@@ -405,43 +564,9 @@ def inline_handler(inline_query):
                 description="Поржать на сегодня"
             )
             results.append(result4)
-            print(f"  ✅ Мем добавлен")
-        
-        # 6. Инструкция
-        help_text = (
-            "📖 **Как пользоваться:**\n\n"
-            "**Основные команды:**\n"
-            "• `@randompikcha2_bot` - это меню\n"
-            "• `@randompikcha2_bot кот` - фото по теме\n"
-            "• `@randompikcha2_bot 3` - 3 фото на выбор\n\n"
-            "**Текст на фото:**\n"
-            "• `@randompikcha2_bot \"Привет\"` - фото с текстом\n"
-            "• `@randompikcha2_bot \"Привет\" кот 3` - 3 фото котов с текстом\n\n"
-            "**Случайные фразы:**\n"
-            "• `@randompikcha2_bot randtext` - фото с фразой\n\n"
-            "**Категории фраз:**\n" +
-            ''.join([f"• `@randompikcha2_bot {cat}`\n" for cat in PHRASES.keys()]) +
-            "\n**Мемы и GIF:**\n"
-            "• `@randompikcha2_bot meme` - случайный мем\n"
-            "• `@randompikcha2_bot gif` - случайная GIF\n\n"
-            "**Эмодзи дня:**\n"
-            "• `@randompikcha2_bot emoji` - твоё эмодзи на сегодня\n\n"
-            "⚡️ **Совет:** Добавляй число в конце для нескольких вариантов!"
-        )
         
-        result_help = telebot.types.InlineQueryResultArticle(
-            id=generate_unique_id("menu_help"),
-            title="📖 Инструкция",
-            description="Как пользоваться ботом",
-            input_message_content=telebot.types.InputTextMessageContent(
-                message_text=help_text,
-                parse_mode='Markdown'
-            ),
-            thumbnail_url="https://images.unsplash.com/photo-1486312338219-ce68d2c6f44d?w=200",
-            thumbnail_width=200,
-            thumbnail_height=133
-        )
-        results.append(result_help)
+        # 6. Инструкция (собрана один раз при старте)
+        results.append(MENU_HELP_RESULT)
         
         print(f"📊 Всего результатов: {len(results)}")
         
@@ -455,32 +580,62 @@ def inline_handler(inline_query):
             traceback.print_exc()
             return
 
-    elif len(query_text) < 3:
-        time.sleep(0.2)
+    # Следующие страницы просит клиент при прокрутке - это уже не набор текста
+    page, feed = parse_offset(inline_query.offset)
+    # Первая страница начинает новую ленту, следующие продолжают ленту из offset
+    if page == 0:
+        feed = inline_query.id
+    
+    # Пока пользователь печатает, ждём следующего нажатия вместо фиксированной паузы
+    if page == 0 and not inline_tracker.debounce(user_id, inline_query.id):
+        print(f"  ⏭️ Запрос устарел, пропускаем")
+        return
+    # Границы этапов: устаревший запрос бросает работу и ничего не отвечает
+    check_current = lambda: inline_tracker.check(user_id, inline_query.id)
+    cancelled = inline_tracker.canceller(user_id, inline_query.id)
     
     results = []
+    intent = None
 
     try:
-        text_to_add = None
-        search_query = None
-        is_randtext = False
-        is_gif = False
-        is_meme = False
-        images_count = 1
+        intent = parse_inline_query(query_text, PHRASES)
+        print(f"  → {intent.kind}: тема={intent.search!r} текст={intent.text!r} фраза={intent.phrase!r} x{intent.count}, страница {page}")
+        
+        # Такой же запрос недавно уже собирали - отдаём готовое
+        cached = inline_results.get(intent) if page == 0 else None
+        if cached:
+            # Вместе с результатами - лента, в которой они выданы
+            cached_results, feed = cached
+            answer_inline(inline_query, intent, cached_results, page, feed)
+            return
         
-        original_text = query_text
-        parts = query_text.lower().split()
+        search_query = intent.search
+        # Первая страница - сколько просили (быстро), следующие - не больше INLINE_PAGE_SIZE
+        images_count = intent.count if page == 0 else INLINE_PAGE_SIZE
+        # Уже выданное в этой ленте на следующих страницах не повторяем
+        session = session_key(intent, user_id, feed)
+        seen = candidate_sessions.seen(session) if page > 0 else frozenset()
+        fresh = lambda url: url if url and url not in seen else None
+        is_gif = intent.kind == 'gif'
+        is_meme = intent.kind == 'meme'
+        is_randtext = intent.phrase == 'randtext'
         
-        # Ищем число в конце
-        if parts and parts[-1].isdigit():
-            images_count = min(int(parts[-1]), 5)
-            query_text = ' '.join(parts[:-1])
-            parts = query_text.lower().split()
-            print(f"  → запрошено {images_count} картинок")
+        if is_gif and not GIPHY_API_KEY:
+            print("❌ GIF запрос, но API не настроен")
+            return
         
-        # Эмодзи дня
-        if parts and parts[0] == 'emoji':
-            print(f"  → команда emoji")
+        # Случайный текст выбираем при каждой генерации, а не при разборе
+        text_to_add = intent.text
+        if is_randtext:
+            text_to_add = get_russian_phrase()
+        elif intent.phrase:
+            text_to_add = get_random_phrase(intent.phrase)
+        if text_to_add:
+            print(f"  → текст: {text_to_add[:30]}...")
+
+        # ===== ГЕНЕРАЦИЯ =====
+        check_current()
+        if intent.kind == 'emoji':
             emoji = get_user_emoji(user_id)
             phrase = random.choice(EMOJI_PHRASES).format(emoji=emoji)
             result_id = generate_unique_id("emoji")
@@ -496,158 +651,38 @@ def inline_handler(inline_query):
             results.append(result)
             print(f"  → эмодзи дня для {user_id}: {emoji}")
         
-        elif not query_text:
-            search_query = None
-            print(f"  → {images_count} случайных картинок")
-        else:
-            # Мемы
-            if parts and parts[0] == 'meme':
-                print(f"  → режим MEME")
-                is_meme = True
-                
-                if len(parts) == 1:
-                    search_query = None
-                    text_to_add = None
-                    print(f"  → просто мем без текста")
-                else:
-                    if re.match(r'^".+"', ' '.join(parts[1:])):
-                        text_match = re.search(r'"([^"]+)"', original_text)
-                        if text_match:
-                            text_to_add = text_match.group(1)
-                            remaining = re.sub(r'"[^"]+"', '', original_text.replace('meme', '', 1)).strip()
-                            if remaining and remaining.split() and remaining.split()[-1].isdigit():
-                                remaining = ' '.join(remaining.split()[:-1])
-                            search_query = remaining if remaining else None
-                            print(f"  → текст на меме: {text_to_add[:30]}...")
-                    
-                    elif parts[1] == 'randtext':
-                        is_randtext = True
-                        text_to_add = get_russian_phrase()
-                        search_query = ' '.join(parts[2:]) if len(parts) > 2 else None
-                        print(f"  → фраза на меме: {text_to_add[:30]}...")
-                    
-                    elif parts[1] in PHRASES:
-                        phrase_category = parts[1]
-                        text_to_add = get_random_phrase(phrase_category)
-                        search_query = ' '.join(parts[2:]) if len(parts) > 2 else None
-                        print(f"  → категория на меме: {phrase_category} -> '{text_to_add[:30]}...'")
-                    
-                    else:
-                        search_query = ' '.join(parts[1:])
-                        text_to_add = None
-                        print(f"  → поиск мемов по теме: {search_query}")
-            
-            # GIF
-            elif parts and parts[0] == 'gif':
-                if not GIPHY_API_KEY:
-                    print("❌ GIF запрос, но API не настроен")
-                    return
-                
-                is_gif = True
-                print(f"  → режим GIF")
-                
-                if len(parts) == 1:
-                    search_query = None
-                    text_to_add = None
-                    print(f"  → просто GIF без текста")
-                else:
-                    if re.match(r'^".+"', ' '.join(parts[1:])):
-                        text_match = re.search(r'"([^"]+)"', original_text)
-                        if text_match:
-                            text_to_add = text_match.group(1)
-                            remaining = re.sub(r'"[^"]+"', '', original_text.replace('gif', '', 1)).strip()
-                            if remaining and remaining.split() and remaining.split()[-1].isdigit():
-                                remaining = ' '.join(remaining.split()[:-1])
-                            search_query = remaining if remaining else None
-                            print(f"  → текст на GIF: {text_to_add[:30]}...")
-                    
-                    elif parts[1] == 'randtext':
-                        is_randtext = True
-                        text_to_add = get_russian_phrase()
-                        search_query = ' '.join(parts[2:]) if len(parts) > 2 else None
-                        print(f"  → фраза на GIF: {text_to_add[:30]}...")
-                    
-                    elif parts[1] in PHRASES:
-                        phrase_category = parts[1]
-                        text_to_add = get_random_phrase(phrase_category)
-                        search_query = ' '.join(parts[2:]) if len(parts) > 2 else None
-                        print(f"  → категория на GIF: {phrase_category} -> '{text_to_add[:30]}...'")
-                    
-                    else:
-                        search_query = ' '.join(parts[1:])
-                        text_to_add = None
-                        print(f"  → поиск GIF по тегу: {search_query}")
-            
-            # ФОТО
-            else:
-                if parts and parts[0] == 'randtext':
-                    is_randtext = True
-                    print(f"  → режим randtext для фото")
-                    text_to_add = get_russian_phrase()
-                    search_query = ' '.join(parts[1:]) if len(parts) > 1 else None
-                
-                elif parts and parts[0] in PHRASES:
-                    phrase_category = parts[0]
-                    text_to_add = get_random_phrase(phrase_category)
-                    search_query = ' '.join(parts[1:]) if len(parts) > 1 else None
-                    print(f"  → категория фото: {phrase_category} -> '{text_to_add[:30]}...'")
-                
-                elif re.match(r'^".+"', query_text) or (parts and parts[0].startswith('"')):
-                    text_match = re.search(r'"([^"]+)"', original_text)
-                    if text_match:
-                        text_to_add = text_match.group(1)
-                        remaining = re.sub(r'"[^"]+"', '', original_text).strip()
-                        if remaining and remaining.split() and remaining.split()[-1].isdigit():
-                            remaining = ' '.join(remaining.split()[:-1])
-                        search_query = remaining if remaining else None
-                        print(f"  → текст на фото: {text_to_add[:30]}...")
-                
-                elif query_text:
-                    print(f"  → поиск фото: {query_text}")
-                    search_query = query_text
-
-        # ===== ГЕНЕРАЦИЯ =====
-        if is_gif:
+        elif is_gif:
             print(f"🎬 Генерируем {images_count} GIF" + (" с текстом" if text_to_add else ""))
             
-            gif_urls = []
-            attempts = 0
-            max_attempts = images_count * 5
-            
-            while len(gif_urls) < images_count and attempts < max_attempts:
-                gif_url = get_random_gif(search_query)
-                if gif_url and gif_url not in gif_urls:
-                    gif_urls.append(gif_url)
-                    print(f"  ✅ Найдено {len(gif_urls)}/{images_count} GIF")
-                attempts += 1
+            gif_urls = fetch_unique(lambda: get_random_gif(search_query), images_count, key=fresh, cancelled=cancelled)
+            check_current()
+            candidate_sessions.add(session, gif_urls)
+            print(f"  ✅ Найдено {len(gif_urls)}/{images_count} GIF")
             
             if len(gif_urls) == 0:
                 print("❌ Не найдено ни одной GIF")
+                # Пустой ответ, чтобы клиент не ждал таймаута
+                answer_inline(inline_query, intent, [], page)
                 return
             
             for i, gif_url in enumerate(gif_urls):
                 print(f"  🎨 Обрабатываем GIF {i+1}/{len(gif_urls)}")
+                check_current()
                 
-                if text_to_add:
-                    full = add_text_to_gif(gif_url, text_to_add)
-                else:
-                    try:
-                        r = requests.get(gif_url, timeout=10)
-                        full = BytesIO(r.content)
-                    except:
-                        continue
+                try:
+                    gif_id = plan_render('gif', gif_url, text_to_add)
+                except:
+                    continue
                 
-                if full:
-                    gif_id = generate_unique_id(f"gif_{i+1}")
-                    temp_images[gif_id] = (full.getvalue(), time.time())
-                    
+                if gif_id:
                     hostname = os.getenv("RAILWAY_PUBLIC_DOMAIN", "localhost")
                     url = f"https://{hostname}/image/{gif_id}"
+                    thumb_url = f"https://{hostname}/image/{plan_render('gif_thumb', gif_url, text_to_add)}"
                     
                     result = telebot.types.InlineQueryResultGif(
                         id=gif_id,
                         gif_url=url,
-                        thumbnail_url=url,
+                        thumbnail_url=thumb_url,
                         gif_width=480,
                         gif_height=360,
                         title=f"GIF {i+1}" + (f": {text_to_add[:20]}..." if text_to_add else ""),
@@ -660,38 +695,37 @@ def inline_handler(inline_query):
         elif is_meme:
             print(f"🎭 Генерируем {images_count} мемов" + (" с текстом" if text_to_add else ""))
             
-            meme_data = []
-            attempts = 0
-            max_attempts = images_count * 5
-            
-            while len(meme_data) < images_count and attempts < max_attempts:
-                meme_url, thumb_url = get_random_meme(search_query)
-                if meme_url and thumb_url:
-                    if not any(url == meme_url for url, _ in meme_data):
-                        meme_data.append((meme_url, thumb_url))
-                        print(f"  ✅ Найдено {len(meme_data)}/{images_count} мемов")
-                attempts += 1
+            meme_data = fetch_unique(
+                lambda: get_random_meme(search_query),
+                images_count,
+                key=lambda data: fresh(data[0]) if data[0] and data[1] else None,
+                cancelled=cancelled
+            )
+            check_current()
+            candidate_sessions.add(session, [meme_url for meme_url, _ in meme_data])
+            print(f"  ✅ Найдено {len(meme_data)}/{images_count} мемов")
             
             if len(meme_data) == 0:
                 print("❌ Не найдено ни одного мема")
+                # Пустой ответ, чтобы клиент не ждал таймаута
+                answer_inline(inline_query, intent, [], page)
                 return
             
             for i, (meme_url, thumb_url) in enumerate(meme_data):
                 print(f"  🎨 Обрабатываем мем {i+1}/{len(meme_data)}")
+                check_current()
                 
                 if text_to_add:
-                    full = add_text_to_image(meme_url, text_to_add)
-                    if full:
-                        meme_id = generate_unique_id(f"meme_text_{i+1}")
-                        temp_images[meme_id] = (full.getvalue(), time.time())
-                        
+                    meme_id = plan_render('img', meme_url, text_to_add)
+                    if meme_id:
                         hostname = os.getenv("RAILWAY_PUBLIC_DOMAIN", "localhost")
                         url = f"https://{hostname}/image/{meme_id}"
+                        thumb_url = f"https://{hostname}/image/{plan_render('img_thumb', meme_url, text_to_add)}"
                         
                         result = telebot.types.InlineQueryResultPhoto(
                             id=meme_id,
                             photo_url=url,
-                            thumbnail_url=url,
+                            thumbnail_url=thumb_url,
                             photo_width=1080,
                             photo_height=720,
                             title=f"Мем {i+1}: {text_to_add[:30]}...",
@@ -717,36 +751,31 @@ def inline_handler(inline_query):
         elif text_to_add or is_randtext:
             print(f"🖼️ Генерируем {images_count} картинок с текстом: '{text_to_add[:30]}...'")
             
-            image_urls = []
-            attempts = 0
-            max_attempts = images_count * 5
-            
-            while len(image_urls) < images_count and attempts < max_attempts:
-                image_url, _ = get_random_image(search_query)
-                if image_url and image_url not in image_urls:
-                    image_urls.append(image_url)
-                    print(f"  ✅ Найдено {len(image_urls)}/{images_count} URL")
-                attempts += 1
+            image_urls = fetch_unique(lambda: get_random_image(search_query)[0], images_count, key=fresh, cancelled=cancelled)
+            check_current()
+            candidate_sessions.add(session, image_urls)
+            print(f"  ✅ Найдено {len(image_urls)}/{images_count} URL")
             
             if len(image_urls) == 0:
                 print("❌ Не найдено ни одной картинки")
+                # Пустой ответ, чтобы клиент не ждал таймаута
+                answer_inline(inline_query, intent, [], page)
                 return
             
             for i, image_url in enumerate(image_urls):
                 print(f"  🎨 Генерируем картинку {i+1}/{len(image_urls)}")
-                full = add_text_to_image(image_url, text_to_add)
+                check_current()
+                image_id = plan_render('img', image_url, text_to_add)
                 
-                if full:
-                    image_id = generate_unique_id(f"text_{i+1}")
-                    temp_images[image_id] = (full.getvalue(), time.time())
-                    
+                if image_id:
                     hostname = os.getenv("RAILWAY_PUBLIC_DOMAIN", "localhost")
                     url = f"https://{hostname}/image/{image_id}"
+                    thumb_url = f"https://{hostname}/image/{plan_render('img_thumb', image_url, text_to_add)}"
                     
                     result = telebot.types.InlineQueryResultPhoto(
                         id=image_id,
                         photo_url=url,
-                        thumbnail_url=url,
+                        thumbnail_url=thumb_url,
                         photo_width=1080,
                         photo_height=720,
                         title=f"Вариант {i+1}: {text_to_add[:30]}...",
@@ -759,17 +788,15 @@ def inline_handler(inline_query):
         else:
             print(f"🖼️ Генерируем {images_count} картинок по запросу: '{search_query or 'случайная'}'")
             
-            image_data = []
-            attempts = 0
-            max_attempts = images_count * 5
-            
-            while len(image_data) < images_count and attempts < max_attempts:
-                image_url, thumb_url = get_random_image(search_query)
-                if image_url and thumb_url:
-                    if not any(url == image_url for url, _ in image_data):
-                        image_data.append((image_url, thumb_url))
-                        print(f"  ✅ Найдено {len(image_data)}/{images_count} картинок")
-                attempts += 1
+            image_data = fetch_unique(
+                lambda: get_random_image(search_query),
+                images_count,
+                key=lambda data: fresh(data[0]) if data[0] and data[1] else None,
+                cancelled=cancelled
+            )
+            check_current()
+            candidate_sessions.add(session, [image_url for image_url, _ in image_data])
+            print(f"  ✅ Найдено {len(image_data)}/{images_count} картинок")
             
             for i, (image_url, thumb_url) in enumerate(image_data):
                 result_id = generate_unique_id(f"img_{i+1}")
@@ -787,13 +814,27 @@ def inline_handler(inline_query):
             
             print(f"✅ Сгенерировано {len(results)} картинок")
 
+        check_current()
+    except QuerySuperseded:
+        print(f"  ⏭️ Пришёл новый запрос от {user_id}, бросаем '{query_text}'")
+        return
     except Exception as e:
         print(f"❌ Ошибка: {e}")
         traceback.print_exc()
 
+    if results and intent and page == 0:
+        cache_time, is_personal = telegram_cache_policy(intent)
+        if cache_time and not is_personal:
+            inline_results.put(intent, (results, feed))
+    answer_inline(inline_query, intent, results, page, feed)
+
+def answer_inline(inline_query, intent, results, page=0, feed=''):
+    """Отвечает на inline запрос; кеш Telegram - по типу запроса, next_offset - для прокрутки"""
     try:
         if results:
-            bot.answer_inline_query(inline_query.id, results, cache_time=0, is_personal=True)
+            cache_time, is_personal = telegram_cache_policy(intent) if intent else (0, True)
+            bot.answer_inline_query(inline_query.id, results, cache_time=cache_time, is_personal=is_personal,
+                                    next_offset=next_offset(intent, page, feed))
             print(f"✅ Отправлено {len(results)} результатов")
         else:
             bot.answer_inline_query(inline_query.id, [], cache_time=0)
@@ -805,32 +846,50 @@ def inline_handler(inline_query):
 # ========== ЭНДПОИНТ ДЛЯ ФАЙЛОВ ==========
 @app.route('/image/<image_id>', methods=['GET', 'HEAD'])
 def serve_image(image_id):
-    if image_id in temp_images:
-        image_data, _ = temp_images[image_id]
-        
-        if request.method == 'HEAD':
-            response = app.make_response('')
-            response.headers['Content-Type'] = 'image/gif' if image_id.startswith('gif') else 'image/jpeg'
-            response.headers['Content-Length'] = str(len(image_data))
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            response.headers['Cache-Control'] = 'public, max-age=3600'
+    # Сначала только метаданные: HEAD и 304 не требуют чтения самой картинки
+    entry = temp_images.head(image_id)
+    if not entry:
+        # Картинки ещё нет, но может быть рецепт - рисуем при первом запросе
+        try:
+            rendered = render_from_recipe(image_id)
+        except RenderBusy:
+            # Рендер перегружен - клиент повторит запрос
+            response = app.make_response(('Busy', 503))
+            response.headers['Retry-After'] = '2'
             return response
-        
-        mimetype = 'image/gif' if image_id.startswith('gif') else 'image/jpeg'
-        
-        response = send_file(
-            BytesIO(image_data),
-            mimetype=mimetype,
-            as_attachment=False,
-            download_name=f'{image_id}.{"gif" if image_id.startswith("gif") else "jpg"}'
-        )
-        
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Cache-Control'] = 'public, max-age=3600'
-        
-        return response
-        
-    abort(404)
+        if not rendered:
+            abort(404)
+        entry = temp_images.head(image_id)
+        if not entry:
+            abort(404)
+    
+    if request.if_none_match.contains(entry.etag) or request.if_none_match.star_tag:
+        response = app.make_response(('', 304))
+    elif request.method == 'HEAD':
+        response = app.make_response('')
+        response.headers['Content-Type'] = entry.content_type
+        response.headers['Content-Length'] = str(entry.size)
+    else:
+        if entry.data is None and entry.path is None:
+            entry = temp_images.get(image_id)
+            if not entry:
+                abort(404)
+        try:
+            # Файл с диска отдаётся через wsgi.file_wrapper (sendfile в gunicorn)
+            response = send_file(
+                entry.path or BytesIO(entry.data),
+                mimetype=entry.content_type,
+                as_attachment=False,
+                download_name=f'{image_id}.{"gif" if entry.content_type == "image/gif" else "jpg"}',
+                etag=False
+            )
+        except FileNotFoundError:
+            abort(404)
+    
+    response.set_etag(entry.etag)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
 
 # ========== ВЕБХУК ==========
 def setup_webhook():
@@ -856,27 +915,58 @@ def webhook():
         json_string = request.get_data().decode('utf-8')
         try:
             update = telebot.types.Update.de_json(json_string)
-            bot.process_new_updates([update])
-            return 'OK', 200
         except Exception as e:
-            print(f"❌ Ошибка обработки: {e}")
+            print(f"❌ Ошибка разбора обновления: {e}")
             return 'Error', 500
+        # О новом inline запросе узнаём до очереди - старый запрос того же пользователя бросит работу
+        if update.inline_query:
+            inline_tracker.announce(update.inline_query.from_user.id, update.inline_query.id)
+        # Отвечаем Telegram сразу, обработка - в воркерах; 503 - пусть повторит позже
+        if not update_queue.submit(update_key(update), update):
+            print("⚠️ Очередь обновлений переполнена")
+            return 'Busy', 503
+        return 'OK', 200
     abort(403)
 
 @app.route('/')
 def index():
     gif_status = "✅ Доступен" if GIPHY_API_KEY else "❌ Не настроен"
     categories = list(PHRASES.keys()) if PHRASES else []
+    menu_stats = menu_pool.stats()
+    source_stats = source_images.stats()
+    store_stats = temp_images.stats()
     return (
         f'🎨 Объединенный бот работает!<br>'
         f'📸 API фото: {", ".join(available_apis)}<br>'
         f'🎬 GIPHY: {gif_status}<br>'
         f'🎭 Категории фраз: {", ".join(categories) if categories else "нет"}<br>'
         f'🎲 Эмодзи в базе: {len(ALL_EMOJIS)}<br>'
-        f'📦 Файлов в памяти: {len(temp_images)}<br>'
+        f'📦 Файлов в памяти: {store_stats["entries"]} ({store_stats["bytes"] // 1024} КБ из {store_stats["max_bytes"] // 1024}), вытеснено {store_stats["evictions"]}<br>'
+        f'💾 На диске: {store_stats["disk_entries"]} ({store_stats["disk_bytes"] // 1024} КБ)<br>'
+        f'🖼️ Кэш исходников: {source_stats["entries"]} шт, {source_stats["bytes"] // 1024} КБ, hit rate {source_stats["hit_rate"]}, вытеснено {source_stats["evictions"]}<br>'
+        f'🍱 Пул меню: {menu_stats["size"]} готово, попаданий {menu_stats["hits"]}, промахов {menu_stats["misses"]}<br>'
         f'👥 Пользователей с эмодзи: {len(user_emojis)}'
     ), 200
 
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'updates': update_queue.stats(),
+        'render': render_service.stats(),
+        'inline': inline_tracker.stats(),
+        'inline_results': inline_results.stats(),
+        'inline_sessions': candidate_sessions.stats(),
+        'images': temp_images.stats(),
+        'source_cache': source_images.stats(),
+        'gif_cache': source_gifs.stats(),
+        'menu_pool': menu_pool.stats(),
+        'harvester': image_harvester.stats(),
+        'memes': {'templates': meme_templates.stats(), 'reddit': reddit_memes.stats()},
+        'router': provider_router.snapshot(),
+        'quotas': quota_scheduler.stats(),
+        'fallback_served': recent_images.served + recent_gifs.served,
+    })
+
 @app.route('/health')
 def health():
     return 'OK', 200
@@ -0,0 +1,73 @@
+import os
+import threading
+from functools import lru_cache
+
+from PIL import ImageFont
+
+# ========== РЕЕСТР ШРИФТОВ ==========
+FONT_PATHS = [
+    '/app/fonts/Impact.ttf',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
+]
+
+FONT_CACHE_SIZE = int(os.getenv('FONT_CACHE_SIZE', 64))
+WIDTH_CACHE_SIZE = int(os.getenv('WIDTH_CACHE_SIZE', 8192))
+
+_base_font = None
+_base_font_lock = threading.Lock()
+
+
+def get_base_font():
+    """Загружает шрифт один раз на процесс"""
+    global _base_font
+    if _base_font is None:
+        with _base_font_lock:
+            if _base_font is None:
+                font = None
+                for font_path in FONT_PATHS:
+                    try:
+                        font = ImageFont.truetype(font_path, 100)
+                        print(f"🔤 Шрифт загружен: {font_path}")
+                        break
+                    except Exception:
+                        pass
+                if font is None:
+                    print("⚠️ Шрифты не найдены, используется встроенный")
+                    font = ImageFont.load_default(100)
+                _base_font = font
+    return _base_font
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def get_font(size):
+    """Шрифт нужного размера (LRU-кэш поверх базового)"""
+    base_font = get_base_font()
+    if isinstance(base_font, ImageFont.FreeTypeFont):
+        return base_font.font_variant(size=size)
+    return ImageFont.load_default(size)
+
+
+@lru_cache(maxsize=WIDTH_CACHE_SIZE)
+def text_bbox(size, text):
+    """Габариты текста при данном размере шрифта (как draw.textbbox от (0, 0))"""
+    return get_font(size).getbbox(text)
+
+
+def text_width(size, text):
+    """Ширина закрашенной области текста"""
+    bbox = text_bbox(size, text)
+    return bbox[2] - bbox[0]
+
+
+@lru_cache(maxsize=WIDTH_CACHE_SIZE)
+def text_advance(size, text):
+    """Ширина продвижения (advance) глифа или слова"""
+    return get_font(size).getlength(text)
+
+
+def font_cache_info():
+    return {
+        'fonts': get_font.cache_info()._asdict(),
+        'bboxes': text_bbox.cache_info()._asdict(),
+        'advances': text_advance.cache_info()._asdict(),
+    }
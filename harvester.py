@@ -0,0 +1,128 @@
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+# ========== ФОНОВЫЙ СБОР КАРТИНОК ==========
+HARVEST_POOL_SIZE = int(os.getenv('HARVEST_POOL_SIZE', 60))
+HARVEST_REFILL_BELOW = int(os.getenv('HARVEST_REFILL_BELOW', 10))
+HARVEST_MAX_QUERIES = int(os.getenv('HARVEST_MAX_QUERIES', 50))
+HARVEST_INTERVAL = float(os.getenv('HARVEST_INTERVAL', 2))
+
+
+class ImageHarvester:
+    """Пулы готовых (url, thumb) по запросам, которые фоном пополняются целыми страницами
+
+    fetchers - словарь провайдер -> функция(query), возвращающая список
+    (url, thumb) за один запрос к API. Пополняются популярные запросы и
+    те, что недавно спрашивали пользователи.
+    """
+
+    def __init__(self, fetchers, popular=(), available=None, pool_size=HARVEST_POOL_SIZE, refill_below=HARVEST_REFILL_BELOW,
+                 max_queries=HARVEST_MAX_QUERIES, interval=HARVEST_INTERVAL):
+        self.fetchers = fetchers
+        self.available = available or (lambda provider: True)
+        self.popular = [q.lower() for q in popular]
+        self.pool_size = pool_size
+        self.refill_below = refill_below
+        self.max_queries = max_queries
+        self.interval = interval
+        self.pools = {}
+        self.recent = OrderedDict()
+        self.provider_turn = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.failures = 0
+
+    def start(self):
+        if self.fetchers:
+            threading.Thread(target=self._harvest_loop, name="image-harvester", daemon=True).start()
+
+    def take(self, query):
+        """Достаёт картинку из пула запроса или возвращает None (тогда нужен живой запрос)"""
+        query = query.lower().strip()
+        with self.lock:
+            self.recent[query] = time.time()
+            self.recent.move_to_end(query)
+            while len(self.recent) > self.max_queries:
+                stale, _ = self.recent.popitem(last=False)
+                if stale not in self.popular:
+                    self.pools.pop(stale, None)
+
+            pool = self.pools.get(query)
+            item = pool.popleft() if pool else None
+            if item:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if not pool or len(pool) < self.refill_below:
+                self.wakeup.set()
+        return item
+
+    def _queries_to_refill(self):
+        with self.lock:
+            queries = list(dict.fromkeys(list(self.recent.keys())[::-1] + self.popular))
+            return [q for q in queries if len(self.pools.get(q) or ()) < self.refill_below]
+
+    def _next_provider(self, query):
+        # Выключенных маршрутизатором провайдеров пропускаем
+        providers = [p for p in self.fetchers if self.available(p)]
+        if not providers:
+            return None
+        turn = self.provider_turn.get(query, random.randrange(len(providers)))
+        self.provider_turn[query] = turn + 1
+        return providers[turn % len(providers)]
+
+    def harvest(self, query):
+        """Одна страница от очередного провайдера в пул запроса"""
+        provider = self._next_provider(query)
+        if provider is None:
+            return 0
+        try:
+            items = self.fetchers[provider](query) or []
+        except Exception as e:
+            print(f"⚠️ Сбор {provider} '{query}': {e}")
+            items = []
+
+        items = [item for item in items if item[0] and item[1]]
+        random.shuffle(items)
+        with self.lock:
+            if not items:
+                self.failures += 1
+                return 0
+            self.batches += 1
+            pool = self.pools.setdefault(query, deque())
+            known = {url for url, _ in pool}
+            added = 0
+            for item in items:
+                if len(pool) >= self.pool_size:
+                    break
+                if item[0] not in known:
+                    pool.append(item)
+                    known.add(item[0])
+                    added += 1
+        return added
+
+    def _harvest_loop(self):
+        while True:
+            self.wakeup.wait(timeout=60)
+            self.wakeup.clear()
+            for query in self._queries_to_refill():
+                self.harvest(query)
+                # Не выбираем квоты провайдеров залпом
+                time.sleep(self.interval)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queries': len(self.pools),
+                'items': sum(len(pool) for pool in self.pools.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'batches': self.batches,
+                'failures': self.failures,
+            }
@@ -0,0 +1,48 @@
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# ========== HTTP КЛИЕНТ ==========
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS', 16))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 16))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 10))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))
+HTTP_BACKOFF = float(os.getenv('HTTP_BACKOFF', 0.3))
+
+USER_AGENT = 'tgbotrandompic/1.0'
+
+
+def create_session():
+    """Сессия с пулом keep-alive соединений на каждый хост и повторами с backoff"""
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=HTTP_RETRIES,
+        status=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        # 429 не повторяем: это квота, повтор её только добьёт
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
+
+session = create_session()
+
+
+def http_get(url, timeout=None, **kwargs):
+    """GET через общий пул; timeout задаёт таймаут чтения, подключение - HTTP_CONNECT_TIMEOUT"""
+    return session.get(url, timeout=(HTTP_CONNECT_TIMEOUT, timeout or HTTP_READ_TIMEOUT), **kwargs)
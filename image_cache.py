@@ -0,0 +1,96 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# ========== КЭШ ИСХОДНЫХ КАРТИНОК ==========
+SOURCE_CACHE_BYTES = int(os.getenv('SOURCE_CACHE_MB', 64)) * 1024 * 1024
+SOURCE_GIF_CACHE_BYTES = int(os.getenv('SOURCE_GIF_CACHE_MB', 32)) * 1024 * 1024
+
+
+def image_nbytes(img):
+    return img.width * img.height * len(img.getbands())
+
+
+class SourceImageCache:
+    """LRU декодированных и уменьшенных исходников по URL с лимитом по байтам
+
+    Одновременные промахи по одному URL склеиваются: качает и декодирует
+    только первый поток, остальные ждут его результат. Картинки в кэше
+    общие - перед рисованием на них нужно делать copy().
+
+    sizer(value) считает байты записи; для сырых байтов (GIF) - len.
+    """
+
+    def __init__(self, loader, max_bytes=SOURCE_CACHE_BYTES, sizer=image_nbytes):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.sizer = sizer
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, url):
+        with self.lock:
+            img = self.entries.get(url)
+            if img is not None:
+                self.entries.move_to_end(url)
+                self.hits += 1
+                return img
+
+            future = self.loading.get(url)
+            if future is not None:
+                self.coalesced += 1
+                owner = False
+            else:
+                future = Future()
+                self.loading[url] = future
+                self.misses += 1
+                owner = True
+
+        if not owner:
+            return future.result()
+
+        try:
+            img = self.loader(url)
+        except Exception as e:
+            with self.lock:
+                del self.loading[url]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            del self.loading[url]
+            self._store(url, img)
+        future.set_result(img)
+        return img
+
+    def _store(self, url, img):
+        size = self.sizer(img)
+        if size > self.max_bytes:
+            return
+        self.entries[url] = img
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= self.sizer(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'hit_rate': round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+            }
@@ -0,0 +1,379 @@
+import atexit
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# ========== ХРАНИЛИЩЕ ГОТОВЫХ КАРТИНОК ==========
+IMAGE_STORE_BYTES = int(os.getenv('IMAGE_STORE_MB', 128)) * 1024 * 1024
+IMAGE_TTL = int(os.getenv('IMAGE_TTL', 900))
+IMAGE_SPILL_DIR = os.getenv('IMAGE_SPILL_DIR', '')
+IMAGE_SPILL_BYTES = int(os.getenv('IMAGE_SPILL_MB', 1024)) * 1024 * 1024
+IMAGE_SPILL_THRESHOLD = int(os.getenv('IMAGE_SPILL_THRESHOLD_KB', 1024)) * 1024
+IMAGE_STORE_BACKEND = os.getenv('IMAGE_STORE_BACKEND', 'memory')
+IMAGE_STORE_PATH = os.getenv('IMAGE_STORE_PATH', '/tmp/tgbot_images.db')
+IMAGE_RECIPES_MAX = int(os.getenv('IMAGE_RECIPES_MAX', 20000))
+
+# data - байты в памяти, path - файл на диске (заполнено что-то одно)
+StoredImage = namedtuple('StoredImage', ['data', 'content_type', 'created', 'size', 'path', 'etag'])
+
+
+def content_etag(data):
+    """Сильный ETag по содержимому"""
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+class ImageStore:
+    """Потокобезопасное LRU-хранилище картинок с лимитом по байтам и TTL на запись
+
+    Если задан spill_dir, вытесняемые из памяти записи и крупные файлы
+    (от spill_threshold байт) уходят на диск, а не выбрасываются. Такие
+    записи отдаются файлом, без загрузки в память процесса.
+
+    Рецепты (put_recipe) - маленькие описания ещё не отрендеренных
+    картинок: по ним картинка рисуется при первом запросе.
+    """
+
+    def __init__(self, max_bytes=IMAGE_STORE_BYTES, ttl=IMAGE_TTL, spill_dir=IMAGE_SPILL_DIR,
+                 spill_bytes=IMAGE_SPILL_BYTES, spill_threshold=IMAGE_SPILL_THRESHOLD, max_recipes=IMAGE_RECIPES_MAX):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.recipes = OrderedDict()  # id -> (created, recipe)
+        self.max_recipes = max_recipes
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejected = 0
+
+        self.spill_dir = None
+        self.spill_bytes = spill_bytes
+        self.spill_threshold = spill_threshold
+        self.disk_entries = OrderedDict()
+        self.spilling = {}
+        self.spill_seq = itertools.count()
+        self.disk_bytes = 0
+        self.spills = 0
+        self.disk_evictions = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            # Свой подкаталог на процесс, чтобы не путаться с файлами других воркеров
+            self.spill_dir = tempfile.mkdtemp(prefix='images-', dir=spill_dir)
+            atexit.register(shutil.rmtree, self.spill_dir, True)
+
+    def put(self, image_id, data, content_type='image/jpeg'):
+        size = len(data)
+        entry = StoredImage(data, content_type, time.time(), size, None, content_etag(data))
+
+        if self.spill_dir and size >= self.spill_threshold:
+            with self.lock:
+                self._remove(image_id)
+                # Пока пишется на диск, запись видна (и удаляема) через self.spilling
+                self.spilling[image_id] = entry
+            return self._spill(image_id, entry)
+
+        to_spill = []
+        with self.lock:
+            self._remove(image_id)
+            if size > self.max_bytes:
+                self.rejected += 1
+                return False
+            self.entries[image_id] = entry
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                evicted_id, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.size
+                if self.spill_dir:
+                    self.spilling[evicted_id] = evicted
+                    to_spill.append((evicted_id, evicted))
+                else:
+                    self.evictions += 1
+
+        # Запись на диск - вне блокировки, пока запись видна через self.spilling
+        for evicted_id, evicted in to_spill:
+            self._spill(evicted_id, evicted)
+        return True
+
+    def _spill(self, image_id, entry):
+        # Своё имя файла на каждую запись: перезапись того же id не затрёт чужой файл
+        path = os.path.join(self.spill_dir, f"{image_id}.{next(self.spill_seq)}")
+        try:
+            with open(path, 'wb') as f:
+                f.write(entry.data)
+        except OSError as e:
+            print(f"❌ Не удалось сбросить {image_id} на диск: {e}")
+            with self.lock:
+                if self.spilling.get(image_id) is entry:
+                    del self.spilling[image_id]
+                self.evictions += 1
+            return False
+
+        with self.lock:
+            if self.spilling.get(image_id) is not entry:
+                # Пока писали, запись удалили, она истекла или её перезаписали свежей версией
+                self._unlink(path)
+                return False
+            del self.spilling[image_id]
+            self._remove_disk(image_id)
+            self.disk_entries[image_id] = entry._replace(data=None, path=path)
+            self.disk_bytes += entry.size
+            self.spills += 1
+            while self.disk_bytes > self.spill_bytes:
+                self._remove_disk(next(iter(self.disk_entries)))
+                self.disk_evictions += 1
+        return True
+
+    def get(self, image_id):
+        with self.lock:
+            entry = self.entries.get(image_id) or self.spilling.get(image_id)
+            if entry is None:
+                entry = self.disk_entries.get(image_id)
+                if entry is None:
+                    return None
+                self.disk_entries.move_to_end(image_id)
+            elif image_id in self.entries:
+                self.entries.move_to_end(image_id)
+
+            if time.time() - entry.created > self.ttl:
+                self._remove(image_id)
+                self.expirations += 1
+                return None
+            return entry
+
+    def head(self, image_id):
+        """Метаданные записи; в памяти они идут вместе с байтами, так что это просто get"""
+        return self.get(image_id)
+
+    def put_recipe(self, image_id, recipe):
+        with self.lock:
+            self.recipes[image_id] = (time.time(), recipe)
+            self.recipes.move_to_end(image_id)
+            while len(self.recipes) > self.max_recipes:
+                self.recipes.popitem(last=False)
+
+    def get_recipe(self, image_id):
+        with self.lock:
+            item = self.recipes.get(image_id)
+            if item is None:
+                return None
+            if time.time() - item[0] > self.ttl:
+                del self.recipes[image_id]
+                return None
+            return item[1]
+
+    def __contains__(self, image_id):
+        return self.get(image_id) is not None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries) + len(self.spilling) + len(self.disk_entries)
+
+    def _remove(self, image_id):
+        entry = self.entries.pop(image_id, None)
+        if entry is not None:
+            self.bytes -= entry.size
+        self.spilling.pop(image_id, None)
+        self._remove_disk(image_id)
+
+    def _remove_disk(self, image_id, unlink=True):
+        entry = self.disk_entries.pop(image_id, None)
+        if entry is None:
+            return
+        self.disk_bytes -= entry.size
+        if unlink:
+            self._unlink(entry.path)
+
+    def _unlink(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def purge_expired(self):
+        """Удаляет просроченные записи, возвращает их количество"""
+        now = time.time()
+        with self.lock:
+            expired = [k for k, entry in self.entries.items() if now - entry.created > self.ttl]
+            expired += [k for k, entry in self.disk_entries.items() if now - entry.created > self.ttl]
+            for image_id in expired:
+                self._remove(image_id)
+            self.expirations += len(expired)
+            for image_id in [k for k, (created, _) in self.recipes.items() if now - created > self.ttl]:
+                del self.recipes[image_id]
+        return len(expired)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'backend': 'memory',
+                'entries': len(self.entries) + len(self.spilling) + len(self.disk_entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'rejected': self.rejected,
+                'disk_entries': len(self.disk_entries),
+                'disk_bytes': self.disk_bytes,
+                'spills': self.spills,
+                'disk_evictions': self.disk_evictions,
+                'recipes': len(self.recipes),
+            }
+
+
+class SqliteImageStore:
+    """Общее для всех воркеров gunicorn хранилище на SQLite в режиме WAL
+
+    Любой процесс может отдать картинку, которую отрендерил другой. Лимит
+    по байтам, LRU и TTL - как у ImageStore, но состояние живёт в файле.
+    """
+
+    # Время доступа обновляем не чаще, чем раз в столько секунд - меньше записей
+    TOUCH_INTERVAL = 30
+
+    def __init__(self, path=IMAGE_STORE_PATH, max_bytes=IMAGE_STORE_BYTES, ttl=IMAGE_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.local = threading.local()
+        self.evictions = 0
+        self.expirations = 0
+        self.rejected = 0
+
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS images ('
+                'id TEXT PRIMARY KEY, content_type TEXT NOT NULL, created REAL NOT NULL, '
+                'accessed REAL NOT NULL, size INTEGER NOT NULL, etag TEXT, data BLOB NOT NULL)'
+            )
+            # Базы, созданные до появления ETag
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(images)')]
+            if 'etag' not in columns:
+                conn.execute('ALTER TABLE images ADD COLUMN etag TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS images_accessed ON images (accessed)')
+            conn.execute('CREATE INDEX IF NOT EXISTS images_created ON images (created)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS recipes (id TEXT PRIMARY KEY, created REAL NOT NULL, recipe TEXT NOT NULL)'
+            )
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def put(self, image_id, data, content_type='image/jpeg'):
+        size = len(data)
+        if size > self.max_bytes:
+            self.rejected += 1
+            return False
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'INSERT OR REPLACE INTO images (id, content_type, created, accessed, size, etag, data) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (image_id, content_type, now, now, size, content_etag(data), sqlite3.Binary(data))
+            )
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM images').fetchone()[0]
+            while total > self.max_bytes:
+                victims = conn.execute(
+                    'SELECT id, size FROM images WHERE id != ? ORDER BY accessed LIMIT 32', (image_id,)
+                ).fetchall()
+                if not victims:
+                    break
+                for victim_id, victim_size in victims:
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute('DELETE FROM images WHERE id = ?', (victim_id,))
+                    total -= victim_size
+                    self.evictions += 1
+        return True
+
+    def _fetch(self, image_id, with_data):
+        conn = self._conn()
+        columns = 'content_type, created, accessed, size, etag' + (', data' if with_data else '')
+        row = conn.execute(f'SELECT {columns} FROM images WHERE id = ?', (image_id,)).fetchone()
+        if row is None:
+            return None
+        content_type, created, accessed, size, etag = row[:5]
+        now = time.time()
+        if now - created > self.ttl:
+            conn.execute('DELETE FROM images WHERE id = ?', (image_id,))
+            self.expirations += 1
+            return None
+        if now - accessed > self.TOUCH_INTERVAL:
+            conn.execute('UPDATE images SET accessed = ? WHERE id = ?', (now, image_id))
+        data = bytes(row[5]) if with_data else None
+        return StoredImage(data, content_type, created, size, None, etag)
+
+    def get(self, image_id):
+        return self._fetch(image_id, with_data=True)
+
+    def head(self, image_id):
+        """Метаданные записи без чтения самих байтов"""
+        return self._fetch(image_id, with_data=False)
+
+    def put_recipe(self, image_id, recipe):
+        self._conn().execute(
+            'INSERT OR REPLACE INTO recipes (id, created, recipe) VALUES (?, ?, ?)',
+            (image_id, time.time(), json.dumps(recipe, ensure_ascii=False))
+        )
+
+    def get_recipe(self, image_id):
+        row = self._conn().execute('SELECT created, recipe FROM recipes WHERE id = ?', (image_id,)).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return None
+        return json.loads(row[1])
+
+    def __contains__(self, image_id):
+        row = self._conn().execute('SELECT created FROM images WHERE id = ?', (image_id,)).fetchone()
+        return row is not None and time.time() - row[0] <= self.ttl
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def purge_expired(self):
+        """Удаляет просроченные записи, возвращает их количество"""
+        conn = self._conn()
+        cursor = conn.execute('DELETE FROM images WHERE created < ?', (time.time() - self.ttl,))
+        self.expirations += cursor.rowcount
+        conn.execute('DELETE FROM recipes WHERE created < ?', (time.time() - self.ttl,))
+        return cursor.rowcount
+
+    def stats(self):
+        conn = self._conn()
+        entries, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images').fetchone()
+        recipes = conn.execute('SELECT COUNT(*) FROM recipes').fetchone()[0]
+        return {
+            'backend': 'sqlite',
+            'entries': entries,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+            # Счётчики ниже - только этого процесса
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'rejected': self.rejected,
+            'disk_entries': 0,
+            'disk_bytes': 0,
+            'recipes': recipes,
+        }
+
+
+def create_image_store():
+    """Хранилище по IMAGE_STORE_BACKEND: memory (в процессе) или sqlite (общее для воркеров)"""
+    if IMAGE_STORE_BACKEND == 'sqlite':
+        print(f"🗄️ Хранилище картинок: SQLite {IMAGE_STORE_PATH}")
+        return SqliteImageStore()
+    return ImageStore()
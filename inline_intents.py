@@ -0,0 +1,200 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# ========== РАЗБОР INLINE ЗАПРОСОВ ==========
+MAX_INLINE_COUNT = 5
+INLINE_RESULT_TTL = int(os.getenv('INLINE_RESULT_TTL', 60))
+INLINE_RESULT_ENTRIES = int(os.getenv('INLINE_RESULT_ENTRIES', 500))
+# Сколько Telegram кеширует ответ у себя: для поиска - общий на всех кеш
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 30))
+INLINE_EMOJI_CACHE_TIME = int(os.getenv('INLINE_EMOJI_CACHE_TIME', 300))
+
+# kind: photo / meme / gif / emoji
+# text - текст из кавычек, phrase - 'randtext' или категория фраз
+InlineIntent = namedtuple('InlineIntent', ['kind', 'search', 'text', 'phrase', 'count'])
+
+
+def _quoted(original_text, command=None):
+    """Текст в кавычках и то, что осталось от запроса после него (без команды и числа)"""
+    text_match = re.search(r'"([^"]+)"', original_text)
+    if not text_match:
+        return None, None
+    rest = original_text.replace(command, '', 1) if command else original_text
+    remaining = re.sub(r'"[^"]+"', '', rest).strip()
+    if remaining and remaining.split()[-1].isdigit():
+        remaining = ' '.join(remaining.split()[:-1])
+    return text_match.group(1), remaining or None
+
+
+def _parse_mode_args(kind, args, original_text, categories):
+    """Аргументы после meme/gif: текст в кавычках, randtext, категория или тема поиска"""
+    if not args:
+        return InlineIntent(kind, None, None, None, 1)
+    if re.match(r'^".+"', ' '.join(args)):
+        text, search = _quoted(original_text, kind)
+        return InlineIntent(kind, search, text, None, 1)
+    if args[0] == 'randtext' or args[0] in categories:
+        return InlineIntent(kind, ' '.join(args[1:]) or None, None, args[0], 1)
+    return InlineIntent(kind, ' '.join(args), None, None, 1)
+
+
+def parse_inline_query(query_text, categories=()):
+    """Разбирает непустой inline запрос в InlineIntent"""
+    original_text = query_text
+    parts = query_text.lower().split()
+    count = 1
+
+    # Число в конце - количество вариантов
+    if parts and parts[-1].isdigit():
+        count = min(int(parts[-1]), MAX_INLINE_COUNT)
+        query_text = ' '.join(parts[:-1])
+        parts = query_text.split()
+
+    if parts and parts[0] == 'emoji':
+        intent = InlineIntent('emoji', None, None, None, 1)
+    elif not query_text:
+        intent = InlineIntent('photo', None, None, None, count)
+    elif parts[0] in ('meme', 'gif'):
+        intent = _parse_mode_args(parts[0], parts[1:], original_text, categories)
+    elif parts[0] == 'randtext' or parts[0] in categories:
+        intent = InlineIntent('photo', ' '.join(parts[1:]) or None, None, parts[0], count)
+    elif re.match(r'^".+"', query_text) or parts[0].startswith('"'):
+        text, search = _quoted(original_text)
+        intent = InlineIntent('photo', search, text, None, count)
+    else:
+        intent = InlineIntent('photo', query_text, None, None, count)
+    return intent._replace(count=count if intent.kind != 'emoji' else 1)
+
+
+def cache_key(intent):
+    """Нормализованный ключ: регистр и лишние пробелы в теме поиска не важны"""
+    search = ' '.join(intent.search.lower().split()) if intent.search else None
+    return intent._replace(search=search)
+
+
+def telegram_cache_policy(intent):
+    """(cache_time, is_personal) для answer_inline_query
+
+    Эмодзи дня у каждого своё - личный кеш. Случайные выдачи (без темы
+    и текста, randtext, категории) не кешируем, чтобы повтор давал новое.
+    Поиск и свой текст - общий кеш для всех пользователей.
+    """
+    if intent.kind == 'emoji':
+        return INLINE_EMOJI_CACHE_TIME, True
+    if intent.phrase or not (intent.search or intent.text):
+        return 0, False
+    return INLINE_CACHE_TIME, False
+
+
+class InlineResultCache:
+    """Готовые списки inline результатов по нормализованному запросу с коротким TTL"""
+
+    def __init__(self, ttl=INLINE_RESULT_TTL, max_entries=INLINE_RESULT_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, intent):
+        key = cache_key(intent)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry[0] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, intent, results):
+        key = cache_key(intent)
+        with self.lock:
+            self.entries[key] = (time.time(), results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+# ========== ПОСТРАНИЧНАЯ ВЫДАЧА ==========
+INLINE_PAGE_SIZE = int(os.getenv('INLINE_PAGE_SIZE', 5))
+INLINE_MAX_PAGES = int(os.getenv('INLINE_MAX_PAGES', 10))
+INLINE_SESSION_TTL = int(os.getenv('INLINE_SESSION_TTL', 600))
+PAGED_KINDS = ('photo', 'meme', 'gif')
+
+
+def next_offset(intent, page, feed=''):
+    """offset следующей страницы для Telegram; пустая строка - страниц больше нет
+
+    В offset вместе с номером страницы едет feed - id ленты, начатой на
+    первой странице: по нему следующие страницы находят уже выданное.
+    """
+    if intent is None or intent.kind not in PAGED_KINDS or page + 1 >= INLINE_MAX_PAGES:
+        return ''
+    return f"{page + 1}:{feed}" if feed else str(page + 1)
+
+
+def parse_offset(offset):
+    """offset от Telegram -> (страница, feed); пустой или непонятный - первая страница"""
+    page, _, feed = (offset or '').partition(':')
+    if not page.isdigit():
+        return 0, ''
+    return int(page), feed
+
+
+def session_key(intent, user_id, feed=''):
+    """Общая выдача - одна лента на всех, случайная - своя у каждого пользователя
+
+    Каждая первая страница начинает новую ленту (feed), поэтому выданное
+    кому-то раньше не вычитается из первой страницы у следующих.
+    """
+    cache_time, is_personal = telegram_cache_policy(intent)
+    return (None if cache_time and not is_personal else user_id, cache_key(intent._replace(count=None)), feed)
+
+
+class CandidateSessions:
+    """Уже выданные по запросу адреса, чтобы следующие страницы не повторялись"""
+
+    def __init__(self, ttl=INLINE_SESSION_TTL, max_entries=INLINE_RESULT_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def seen(self, key):
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None or time.time() - session[0] > self.ttl:
+                return frozenset()
+            return frozenset(session[1])
+
+    def add(self, key, urls):
+        with self.lock:
+            session = self.sessions.get(key)
+            if session is None or time.time() - session[0] > self.ttl:
+                session = self.sessions[key] = (time.time(), set())
+            session[1].update(url for url in urls if url)
+            self.sessions.move_to_end(key)
+            while len(self.sessions) > self.max_entries:
+                self.sessions.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'sessions': len(self.sessions),
+                'urls': sum(len(urls) for _, urls in self.sessions.values()),
+            }
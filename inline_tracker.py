@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+
+# ========== УСТАРЕВШИЕ INLINE ЗАПРОСЫ ==========
+INLINE_DEBOUNCE_MIN = float(os.getenv('INLINE_DEBOUNCE_MIN', 0.05))
+INLINE_DEBOUNCE_MAX = float(os.getenv('INLINE_DEBOUNCE_MAX', 0.6))
+# Паузы длиннее этой - уже не набор текста
+TYPING_GAP = float(os.getenv('INLINE_TYPING_GAP', 1.5))
+FORGET_AFTER = 600
+
+
+class QuerySuperseded(Exception):
+    """От пользователя пришёл более новый inline запрос"""
+
+
+class InlineTracker:
+    """Последний inline запрос каждого пользователя и темп его набора
+
+    announce() вызывается при приёме обновления, ещё до очереди, поэтому
+    обработчик старого запроса узнаёт о новом на ближайшей проверке и
+    бросает работу. Задержка перед обработкой подстраивается под средний
+    интервал между нажатиями пользователя.
+    """
+
+    def __init__(self, min_delay=INLINE_DEBOUNCE_MIN, max_delay=INLINE_DEBOUNCE_MAX, typing_gap=TYPING_GAP):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.typing_gap = typing_gap
+        self.users = {}  # user_id -> [query_id, время прихода, средний интервал]
+        self.cond = threading.Condition()
+        self.announced = 0
+        self.superseded = 0
+        self.debounced = 0
+
+    def announce(self, user_id, query_id):
+        now = time.monotonic()
+        with self.cond:
+            self.announced += 1
+            state = self.users.get(user_id)
+            if state is None:
+                self.users[user_id] = [query_id, now, None]
+            else:
+                gap = now - state[1]
+                if gap < self.typing_gap:
+                    state[2] = gap if state[2] is None else 0.7 * state[2] + 0.3 * gap
+                state[0], state[1] = query_id, now
+            if self.announced % 1000 == 0:
+                self._forget(now)
+            self.cond.notify_all()
+
+    def _forget(self, now):
+        for user_id in [u for u, state in self.users.items() if now - state[1] > FORGET_AFTER]:
+            del self.users[user_id]
+
+    def _is_current(self, user_id, query_id):
+        state = self.users.get(user_id)
+        return state is None or state[0] == query_id
+
+    def is_current(self, user_id, query_id):
+        with self.cond:
+            return self._is_current(user_id, query_id)
+
+    def check(self, user_id, query_id):
+        """Граница этапа: бросает QuerySuperseded, если запрос уже не последний"""
+        with self.cond:
+            if self._is_current(user_id, query_id):
+                return
+            self.superseded += 1
+        raise QuerySuperseded(query_id)
+
+    def canceller(self, user_id, query_id):
+        return lambda: not self.is_current(user_id, query_id)
+
+    def debounce(self, user_id, query_id):
+        """Ждёт следующего нажатия, пока пользователь печатает; False - запрос устарел"""
+        with self.cond:
+            state = self.users.get(user_id)
+            if state is None or state[2] is None or time.monotonic() - state[1] > self.typing_gap:
+                return self._is_current(user_id, query_id)
+            delay = min(max(state[2] * 1.5, self.min_delay), self.max_delay)
+            self.debounced += 1
+            self.cond.wait_for(lambda: not self._is_current(user_id, query_id), timeout=delay)
+            if self._is_current(user_id, query_id):
+                return True
+            self.superseded += 1
+            return False
+
+    def stats(self):
+        with self.cond:
+            return {
+                'users': len(self.users),
+                'announced': self.announced,
+                'debounced': self.debounced,
+                'superseded': self.superseded,
+            }
@@ -0,0 +1,78 @@
+import os
+from io import BytesIO
+
+# ========== КОДИРОВАНИЕ JPEG ==========
+# fast - без оптимизации Хаффмана, balanced - как раньше (90 + optimize),
+# size - подбор качества под JPEG_TARGET_KB
+JPEG_PROFILE = os.getenv('JPEG_PROFILE', 'balanced')
+JPEG_TARGET_BYTES = int(os.getenv('JPEG_TARGET_KB', 150)) * 1024
+JPEG_PROGRESSIVE = os.getenv('JPEG_PROGRESSIVE', '0') == '1'
+# 4:4:4, 4:2:2 или 4:2:0; пусто - по умолчанию Pillow (4:2:0)
+JPEG_SUBSAMPLING = os.getenv('JPEG_SUBSAMPLING', '')
+JPEG_MIN_QUALITY = 40
+JPEG_MAX_QUALITY = 90
+
+PROFILES = {
+    'fast': {'quality': 85, 'optimize': False},
+    'balanced': {'quality': 90, 'optimize': True},
+    'size': {'optimize': True},
+}
+
+
+def jpeg_settings():
+    """Текущие настройки кодирования - меняют байты рендера, поэтому входят в его id"""
+    settings = {'profile': JPEG_PROFILE, 'progressive': JPEG_PROGRESSIVE, 'subsampling': JPEG_SUBSAMPLING}
+    if JPEG_PROFILE == 'size':
+        settings['target_bytes'] = JPEG_TARGET_BYTES
+    return settings
+
+
+def _encode(img, **options):
+    output = BytesIO()
+    img.save(output, format='JPEG', **options)
+    return output.getvalue()
+
+
+def encode_jpeg(img, profile=None, target_bytes=None, progressive=None, subsampling=None):
+    """Кодирует картинку в JPEG по профилю, возвращает байты
+
+    Профиль size ищет двоичным поиском наибольшее качество (не выше, чем
+    у balanced), при котором файл укладывается в target_bytes; если не
+    влезает и минимальное - отдаётся результат с JPEG_MIN_QUALITY.
+    Пробы идут без optimize/progressive, итог кодируется с ними один раз.
+    """
+    profile = profile or JPEG_PROFILE
+    options = dict(PROFILES.get(profile, PROFILES['balanced']))
+    progressive = JPEG_PROGRESSIVE if progressive is None else progressive
+    subsampling = JPEG_SUBSAMPLING if subsampling is None else subsampling
+    if progressive:
+        options['progressive'] = True
+    if subsampling:
+        options['subsampling'] = subsampling
+
+    if profile != 'size':
+        return _encode(img, **options)
+
+    target_bytes = target_bytes or JPEG_TARGET_BYTES
+    # Простые картинки влезают сразу - одно кодирование вместо поиска
+    data = _encode(img, quality=JPEG_MAX_QUALITY, **options)
+    if len(data) <= target_bytes:
+        return data
+
+    # Поиск - быстрыми базовыми проходами; optimize/progressive только ужимают итог
+    probe = {key: value for key, value in options.items() if key not in ('optimize', 'progressive')}
+    low, high = JPEG_MIN_QUALITY, JPEG_MAX_QUALITY - 1
+    best_quality, best = JPEG_MIN_QUALITY, None
+    while low <= high:
+        quality = (low + high) // 2
+        data = _encode(img, quality=quality, **probe)
+        if len(data) <= target_bytes:
+            best_quality, best = quality, data
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    final = _encode(img, quality=best_quality, **options)
+    if best is not None and len(final) > len(best):
+        return best
+    return final
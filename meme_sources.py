@@ -0,0 +1,188 @@
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+# ========== ИСТОЧНИКИ МЕМОВ ==========
+MEME_TEMPLATES_TTL = int(os.getenv('MEME_TEMPLATES_TTL', 3600))
+MEME_BATCH_SIZE = int(os.getenv('MEME_BATCH_SIZE', 50))
+MEME_POOL_TTL = int(os.getenv('MEME_POOL_TTL', 1800))
+# Сколько помним, что сабреддит ничего не отдал (404, пусто), и не ходим за ним снова
+MEME_FAILURE_TTL = int(os.getenv('MEME_FAILURE_TTL', 300))
+MEME_FAILURE_KEYS = 1000
+
+
+class TemplateCatalog:
+    """Список шаблонов imgflip в памяти с TTL и обновлением в фоне
+
+    loader() -> список (url, thumb). Пока идёт обновление, отдаётся
+    прежний список; синхронно грузим только при самом первом обращении.
+    """
+
+    def __init__(self, loader, ttl=MEME_TEMPLATES_TTL):
+        self.loader = loader
+        self.ttl = ttl
+        self.items = []
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.refreshes = 0
+        self.failures = 0
+
+    def start(self):
+        threading.Thread(target=self._refresh_loop, name="meme-templates", daemon=True).start()
+
+    def _refresh_loop(self):
+        while True:
+            self.refresh()
+            time.sleep(self.ttl if self.items else 60)
+
+    def refresh(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        try:
+            items = self.loader() or []
+        except Exception as e:
+            print(f"⚠️ Шаблоны мемов: {e}")
+            items = []
+        with self.lock:
+            self.refreshing = False
+            if items:
+                self.items = items
+                self.loaded_at = time.time()
+                self.refreshes += 1
+            else:
+                self.failures += 1
+
+    def random(self):
+        if not self.items:
+            self.refresh()
+        elif time.time() - self.loaded_at > self.ttl:
+            threading.Thread(target=self.refresh, daemon=True).start()
+        items = self.items
+        return random.choice(items) if items else None
+
+    def stats(self):
+        return {
+            'templates': len(self.items),
+            'age': round(time.time() - self.loaded_at) if self.loaded_at else None,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+        }
+
+
+class MemePool:
+    """Пулы мемов по сабреддиту, которые пополняются пачкой за один запрос
+
+    fetch_batch(subreddit, count) -> список (url, thumb); subreddit '' -
+    случайные мемы. Одновременные промахи по одному сабреддиту ждут одну
+    общую загрузку, а не идут к API каждый сам. Блокировка загрузки живёт,
+    только пока её кто-то ждёт; неудачный сабреддит failure_ttl секунд
+    сразу отдаёт None.
+    """
+
+    def __init__(self, fetch_batch, batch_size=MEME_BATCH_SIZE, ttl=MEME_POOL_TTL, failure_ttl=MEME_FAILURE_TTL):
+        self.fetch_batch = fetch_batch
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.refill_locks = {}  # key -> [lock, сколько потоков её держат или ждут]
+        self.failed = OrderedDict()  # key -> время неудачной загрузки
+        self.hits = 0
+        self.batches = 0
+        self.failures = 0
+        self.failures_cached = 0
+
+    def _recently_failed(self, key):
+        with self.lock:
+            failed_at = self.failed.get(key)
+            if failed_at is None:
+                return False
+            if time.time() - failed_at > self.failure_ttl:
+                del self.failed[key]
+                return False
+            self.failures_cached += 1
+            return True
+
+    def _acquire_refill(self, key):
+        with self.lock:
+            entry = self.refill_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+
+    def _release_refill(self, key):
+        with self.lock:
+            entry = self.refill_locks[key]
+            entry[0].release()
+            entry[1] -= 1
+            if not entry[1]:
+                del self.refill_locks[key]
+
+    def _pop(self, key):
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool and time.time() - pool[0] > self.ttl:
+                del self.pools[key]
+                pool = None
+            if pool and pool[1]:
+                return pool[1].popleft()
+            return None
+
+    def take(self, subreddit=''):
+        key = subreddit.lower().strip()
+        item = self._pop(key)
+        if item:
+            with self.lock:
+                self.hits += 1
+            return item
+
+        if self._recently_failed(key):
+            return None
+
+        self._acquire_refill(key)
+        try:
+            # Пока ждали, пул мог пополнить (или не смочь пополнить) соседний поток
+            item = self._pop(key)
+            if item:
+                with self.lock:
+                    self.hits += 1
+                return item
+            if self._recently_failed(key):
+                return None
+            try:
+                items = self.fetch_batch(key, self.batch_size) or []
+            except Exception as e:
+                print(f"⚠️ Мемы '{key or 'случайные'}': {e}")
+                items = []
+            items = [item for item in items if item[0]]
+            random.shuffle(items)
+            with self.lock:
+                if not items:
+                    self.failures += 1
+                    self.failed[key] = time.time()
+                    self.failed.move_to_end(key)
+                    while len(self.failed) > MEME_FAILURE_KEYS:
+                        self.failed.popitem(last=False)
+                    return None
+                self.batches += 1
+                self.pools[key] = (time.time(), deque(items[1:]))
+            return items[0]
+        finally:
+            self._release_refill(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'subreddits': len(self.pools),
+                'items': sum(len(pool) for _, pool in self.pools.values()),
+                'hits': self.hits,
+                'batches': self.batches,
+                'failures': self.failures,
+                'failures_cached': self.failures_cached,
+                'refilling': len(self.refill_locks),
+            }
@@ -0,0 +1,135 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from shared_logic import (
+    PHRASES, get_random_image, get_russian_phrase, get_random_phrase,
+    get_random_meme, add_text_to_image, RenderBusy
+)
+
+# ========== НАСТРОЙКИ ПУЛА МЕНЮ ==========
+MENU_POOL_SIZE = int(os.getenv('MENU_POOL_SIZE', 3))
+MENU_POOL_WORKERS = int(os.getenv('MENU_POOL_WORKERS', 1))
+MENU_POOL_TTL = int(os.getenv('MENU_POOL_TTL', 600))
+
+
+def build_menu_bundle():
+    """Собирает один набор для меню: базовое фото, две подписи и мем"""
+    base_image_url, base_thumb_url = get_random_image()
+    if not base_image_url:
+        return None
+
+    bundle = {
+        'created': time.time(),
+        'base_url': base_image_url,
+        'base_thumb': base_thumb_url or base_image_url,
+        'randtext': None,
+        'category': None,
+        'meme': None,
+        'degraded': False,
+    }
+
+    # Очередь рендера полна - отдаём меню без подписанных пунктов, а не теряем его целиком
+    try:
+        random_phrase = get_russian_phrase()
+        full = add_text_to_image(base_image_url, random_phrase)
+        if full:
+            bundle['randtext'] = (random_phrase, full.getvalue())
+
+        if PHRASES:
+            random_category = random.choice(list(PHRASES.keys()))
+            category_phrase = get_random_phrase(random_category)
+            full = add_text_to_image(base_image_url, category_phrase)
+            if full:
+                bundle['category'] = (random_category, category_phrase, full.getvalue())
+    except RenderBusy:
+        print("⚠️ Пул меню: рендер занят, набор без подписей")
+        bundle['degraded'] = True
+
+    meme_url, thumb_url = get_random_meme()
+    if meme_url and thumb_url:
+        bundle['meme'] = (meme_url, thumb_url)
+
+    return bundle
+
+
+class MenuPool:
+    """Фоновый пул готовых наборов для пустого inline-запроса"""
+
+    def __init__(self, size=MENU_POOL_SIZE, workers=MENU_POOL_WORKERS, ttl=MENU_POOL_TTL, builder=build_menu_bundle):
+        self.size = size
+        self.workers = workers
+        self.ttl = ttl
+        self.builder = builder
+        self.bundles = deque()
+        self.building = 0
+        self.cond = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.built = 0
+        self.failed = 0
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._refill_loop, name=f"menu-pool-{i}", daemon=True).start()
+
+    def _is_fresh(self, bundle):
+        return time.time() - bundle['created'] <= self.ttl
+
+    def _refill_loop(self):
+        while True:
+            with self.cond:
+                while len(self.bundles) + self.building >= self.size:
+                    self.cond.wait()
+                self.building += 1
+
+            bundle = None
+            try:
+                bundle = self.builder()
+            except Exception as e:
+                print(f"❌ Пул меню: ошибка сборки: {e}")
+
+            # Урезанный из-за занятого рендера набор годится на месте, но не в пул
+            if bundle and bundle.get('degraded'):
+                bundle = None
+
+            with self.cond:
+                self.building -= 1
+                if bundle:
+                    self.bundles.append(bundle)
+                    self.built += 1
+                else:
+                    self.failed += 1
+
+            if not bundle:
+                # Провайдеры недоступны - не долбим их в цикле
+                time.sleep(5)
+
+    def pop(self):
+        """Возвращает свежий набор из пула или собирает его на месте"""
+        with self.cond:
+            while self.bundles:
+                bundle = self.bundles.popleft()
+                self.cond.notify()
+                if self._is_fresh(bundle):
+                    self.hits += 1
+                    return bundle
+                self.expired += 1
+            self.misses += 1
+
+        return self.builder()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'size': len(self.bundles),
+                'building': self.building,
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'built': self.built,
+                'failed': self.failed,
+            }
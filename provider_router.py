@@ -0,0 +1,211 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# ========== МАРШРУТИЗАЦИЯ ПО ПРОВАЙДЕРАМ ==========
+ROUTER_WINDOW = int(os.getenv('ROUTER_WINDOW', 50))
+ROUTER_WORKERS = int(os.getenv('ROUTER_WORKERS', 32))
+ROUTER_HEDGE = os.getenv('ROUTER_HEDGE', '1') == '1'
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', 1.5))
+HEDGE_MIN_DELAY = 0.2
+HEDGE_MAX_DELAY = 5.0
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', 5))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', 30))
+RATE_LIMIT_COOLDOWN = float(os.getenv('RATE_LIMIT_COOLDOWN', 120))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class ProviderHealth:
+    def __init__(self, window):
+        self.calls = deque(maxlen=window)  # (latency, ok)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.cooldown = BREAKER_COOLDOWN
+        self.consecutive_failures = 0
+        self.rate_limited = 0
+        self.trial_in_flight = False
+
+    def error_rate(self):
+        if not self.calls:
+            return 0.0
+        return sum(1 for _, ok in self.calls if not ok) / len(self.calls)
+
+    def latency(self, q):
+        latencies = [latency for latency, ok in self.calls if ok]
+        return _percentile(latencies, q) if latencies else None
+
+
+class ProviderRouter:
+    """Упорядочивает провайдеров по здоровью, отключает сбоящих и дублирует медленные запросы
+
+    На каждого провайдера - скользящее окно задержек и ошибок, счётчик 429
+    и автомат (circuit breaker): после BREAKER_FAILURES ошибок подряд или
+    429 провайдер выключается на время, потом пропускается один пробный
+    запрос. При ROUTER_HEDGE, если ответа нет дольше p95 задержки,
+    параллельно запускается следующий провайдер.
+
+    Сбой - только исключение из fetch (таймаут, обрыв, 5xx, 429); пустой
+    ответ (None) - здоровый вызов. Исключения из skipped означают, что
+    запрос не отправлялся, и в статистику не попадают.
+    """
+
+    def __init__(self, window=ROUTER_WINDOW, hedge=ROUTER_HEDGE, workers=ROUTER_WORKERS, skipped=()):
+        self.window = window
+        self.skipped = tuple(skipped)
+        self.hedge = hedge
+        self.health = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='provider')
+        self.hedged = 0
+
+    def _health(self, provider):
+        health = self.health.get(provider)
+        if health is None:
+            health = self.health[provider] = ProviderHealth(self.window)
+        return health
+
+    def record(self, provider, latency, ok):
+        with self.lock:
+            health = self._health(provider)
+            health.calls.append((latency, ok))
+            health.trial_in_flight = False
+            if ok:
+                health.consecutive_failures = 0
+                # Автомат, открытый во время запроса (например по 429), поздний успех не закрывает
+                if health.state != OPEN:
+                    health.state = CLOSED
+            else:
+                health.consecutive_failures += 1
+                if health.state == HALF_OPEN or health.consecutive_failures >= BREAKER_FAILURES:
+                    self._open(health, BREAKER_COOLDOWN)
+
+    def skip(self, provider):
+        """Запрос не отправлялся - только снимаем флаг пробного запроса"""
+        with self.lock:
+            self._health(provider).trial_in_flight = False
+
+    def note_rate_limited(self, provider):
+        """429 от провайдера: сразу выключаем его на RATE_LIMIT_COOLDOWN"""
+        with self.lock:
+            health = self._health(provider)
+            health.rate_limited += 1
+            self._open(health, RATE_LIMIT_COOLDOWN)
+        print(f"⛔ {provider}: лимит запросов (429), отключаем на {RATE_LIMIT_COOLDOWN:.0f} с")
+
+    def _open(self, health, cooldown):
+        health.state = OPEN
+        health.opened_at = time.monotonic()
+        health.cooldown = cooldown
+
+    def _available(self, health):
+        if health.state == OPEN and time.monotonic() - health.opened_at >= health.cooldown:
+            health.state = HALF_OPEN
+        if health.state == HALF_OPEN:
+            return not health.trial_in_flight
+        return health.state == CLOSED
+
+    def is_available(self, provider):
+        with self.lock:
+            return self._available(self._health(provider))
+
+    def order(self, providers):
+        """Доступные провайдеры от самого здорового к самому слабому"""
+        with self.lock:
+            ranked = []
+            for index, provider in enumerate(providers):
+                health = self._health(provider)
+                if not self._available(health):
+                    continue
+                latency = health.latency(0.5) or HEDGE_DEFAULT_DELAY
+                ranked.append((latency * (1 + 4 * health.error_rate()), index, provider))
+            return [provider for _, _, provider in sorted(ranked)]
+
+    def hedge_delay(self, provider):
+        with self.lock:
+            health = self._health(provider)
+            p95 = health.latency(0.95) if len(health.calls) >= 5 else None
+        return min(max(p95 or HEDGE_DEFAULT_DELAY, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+    def _launch(self, provider, fetch, pending):
+        with self.lock:
+            health = self._health(provider)
+            if health.state == HALF_OPEN:
+                health.trial_in_flight = True
+        start = time.monotonic()
+        future = self.executor.submit(fetch, provider)
+
+        def on_done(done_future):
+            try:
+                done_future.result()
+                ok = True
+            except self.skipped:
+                self.skip(provider)
+                return
+            except Exception:
+                ok = False
+            self.record(provider, time.monotonic() - start, ok)
+
+        # Результат записывается, даже если запрос уже никому не нужен
+        future.add_done_callback(on_done)
+        pending[future] = provider
+
+    def call(self, providers, fetch):
+        """fetch(provider) -> результат или None, при сбое - исключение; возвращает первый непустой результат"""
+        queue = self.order(providers)
+        pending = {}
+        if queue:
+            self._launch(queue.pop(0), fetch, pending)
+
+        while pending:
+            timeout = None
+            if self.hedge and queue:
+                timeout = self.hedge_delay(list(pending.values())[-1])
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                # Ответа нет дольше p95 - дублируем запрос следующему провайдеру
+                self.hedged += 1
+                self._launch(queue.pop(0), fetch, pending)
+                continue
+
+            for future in done:
+                pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    result = None
+                if result:
+                    return result
+
+            # Неудача - сразу пробуем следующего, не дожидаясь остальных
+            if queue:
+                self._launch(queue.pop(0), fetch, pending)
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            state = {'hedged': self.hedged, 'providers': {}}
+            for provider, health in self.health.items():
+                self._available(health)
+                p50 = health.latency(0.5)
+                p95 = health.latency(0.95)
+                state['providers'][provider] = {
+                    'state': health.state,
+                    'calls': len(health.calls),
+                    'error_rate': round(health.error_rate(), 3),
+                    'p50_ms': round(p50 * 1000) if p50 is not None else None,
+                    'p95_ms': round(p95 * 1000) if p95 is not None else None,
+                    'consecutive_failures': health.consecutive_failures,
+                    'rate_limited': health.rate_limited,
+                }
+            return state
@@ -0,0 +1,161 @@
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+# ========== КВОТЫ ПРОВАЙДЕРОВ ==========
+# Лимиты бесплатных ключей: запросов за период в секундах
+DEFAULT_QUOTAS = {
+    'unsplash': (50, 3600),
+    'pexels': (200, 3600),
+    'pixabay': (100, 60),
+    'giphy': (100, 3600),
+}
+# Сколько токенов фоновые задачи оставляют живым запросам
+QUOTA_RESERVE = float(os.getenv('QUOTA_RESERVE', 0.2))
+MAX_BLOCK_SECONDS = 3600
+
+
+class QuotaExhausted(Exception):
+    """Токенов у провайдера нет - запрос не отправлялся"""
+
+
+def load_quotas():
+    """Лимиты из окружения в виде QUOTA_UNSPLASH=50/3600, иначе значения по умолчанию"""
+    quotas = {}
+    for provider, default in DEFAULT_QUOTAS.items():
+        value = os.getenv(f'QUOTA_{provider.upper()}')
+        try:
+            limit, period = value.split('/')
+            quotas[provider] = (int(limit), int(period))
+        except (AttributeError, ValueError):
+            quotas[provider] = default
+    return quotas
+
+
+class TokenBucket:
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def level(self):
+        now = self._refill()
+        return 0.0 if now < self.blocked_until else self.tokens
+
+    def try_take(self, reserve=0.0):
+        if self.level() >= 1 + reserve * self.capacity:
+            self.tokens -= 1
+            return True
+        return False
+
+    def sync(self, remaining, reset_in=None):
+        """Подстраивает ведро под остаток квоты, о котором сообщил сам провайдер"""
+        self._refill()
+        self.tokens = min(self.tokens, float(remaining))
+        if remaining <= 0 and reset_in:
+            self.blocked_until = time.monotonic() + min(reset_in, MAX_BLOCK_SECONDS)
+
+
+class QuotaScheduler:
+    """Token bucket на каждый ключ API
+
+    Перед запросом провайдеру нужно взять токен; пустое ведро значит, что
+    запрос надо отложить или отдать другому провайдеру. Остаток квоты из
+    заголовков X-Ratelimit-* ответа уточняет ведро.
+    """
+
+    def __init__(self, quotas=None):
+        self.buckets = {provider: TokenBucket(limit, period) for provider, (limit, period) in (quotas or load_quotas()).items()}
+        self.lock = threading.Lock()
+        self.denied = {provider: 0 for provider in self.buckets}
+
+    def available(self, provider, reserve=0.0):
+        with self.lock:
+            bucket = self.buckets.get(provider)
+            return bucket is None or bucket.level() >= 1 + reserve * bucket.capacity
+
+    def try_acquire(self, provider, reserve=0.0):
+        with self.lock:
+            bucket = self.buckets.get(provider)
+            if bucket is None or bucket.try_take(reserve):
+                return True
+            self.denied[provider] += 1
+            return False
+
+    def update_from_headers(self, provider, headers):
+        remaining = headers.get('X-Ratelimit-Remaining')
+        if remaining is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset = headers.get('X-Ratelimit-Reset')
+            reset_in = float(reset) if reset else None
+            # Pexels присылает момент сброса (unix time), Pixabay - секунды до него
+            if reset_in and reset_in > 1e9:
+                reset_in = reset_in - time.time()
+        except ValueError:
+            return
+        with self.lock:
+            bucket = self.buckets.get(provider)
+            if bucket:
+                bucket.sync(remaining, reset_in)
+
+    def exhaust(self, provider, retry_after=None):
+        """Провайдер ответил 429 - ведро пустое до сброса"""
+        with self.lock:
+            bucket = self.buckets.get(provider)
+            if bucket:
+                bucket.sync(0, retry_after or 1 / bucket.rate)
+
+    def stats(self):
+        with self.lock:
+            return {
+                provider: {
+                    'tokens': round(bucket.level(), 1),
+                    'capacity': bucket.capacity,
+                    'denied': self.denied[provider],
+                }
+                for provider, bucket in self.buckets.items()
+            }
+
+
+class FallbackCache:
+    """Недавно выданные результаты по ключу - на случай, когда квоты кончились"""
+
+    def __init__(self, per_key=50, max_keys=200):
+        self.per_key = per_key
+        self.max_keys = max_keys
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.served = 0
+
+    def remember(self, key, result):
+        with self.lock:
+            bucket = self.results.setdefault(key, deque(maxlen=self.per_key))
+            if result not in bucket:
+                bucket.append(result)
+            self.results.move_to_end(key)
+            while len(self.results) > self.max_keys:
+                self.results.popitem(last=False)
+
+    def recall(self, key=None, any_key=False):
+        """Случайный результат по ключу; с any_key, если по нему ничего нет, - по любому"""
+        with self.lock:
+            bucket = self.results.get(key)
+            if not bucket and any_key:
+                buckets = [b for b in self.results.values() if b]
+                bucket = random.choice(buckets) if buckets else None
+            if not bucket:
+                return None
+            self.served += 1
+            return random.choice(bucket)
@@ -0,0 +1,82 @@
+from io import BytesIO
+
+from PIL import Image, ImageSequence, GifImagePlugin
+
+from jpeg_encoder import encode_jpeg
+from text_layout import layout_caption, draw_caption, render_caption_masks, binarize_masks, caption_frame
+
+# ========== ЗАДАЧИ РЕНДЕРА ==========
+# Выполняются в процессах RenderService: на входе и выходе только байты,
+# поэтому модуль не тянет за собой shared_logic с его API и пулами.
+
+# Кадры GIF с общей палитрой оставляем в режиме P - подпись кладётся прямо в палитру
+GifImagePlugin.LOADING_STRATEGY = GifImagePlugin.LoadingStrategy.RGB_AFTER_DIFFERENT_PALETTE_ONLY
+
+
+def caption_image(mode, size, pixels, text):
+    """Накладывает подпись на декодированные пиксели, возвращает JPEG"""
+    img = Image.frombytes(mode, size, pixels)
+
+    layout = layout_caption(text, img.width, img.height)
+    draw_caption(img, layout)
+
+    return encode_jpeg(img)
+
+
+def caption_thumbnail(mode, size, pixels, text, thumb_size):
+    """Маленькая JPEG-превьюшка с подписью из тех же декодированных пикселей"""
+    return _thumbnail_jpeg(Image.frombytes(mode, size, pixels), text, thumb_size)
+
+
+def gif_thumbnail(data, text, thumb_size):
+    """Превьюшка GIF - первый кадр с подписью, в JPEG"""
+    return _thumbnail_jpeg(Image.open(BytesIO(data)).convert('RGB'), text, thumb_size)
+
+
+def _thumbnail_jpeg(img, text, thumb_size):
+    # Подпись раскладывается и рисуется в полном размере, как в самом рендере, и
+    # уменьшается вместе с картинкой: раскладка на 320 px (минимальный шрифт,
+    # отступ в пикселях) выглядела бы иначе
+    if text:
+        draw_caption(img, layout_caption(text, img.width, img.height))
+    img.thumbnail((thumb_size, thumb_size), Image.Resampling.BILINEAR)
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=80)
+    return output.getvalue()
+
+
+def caption_gif(data, text):
+    """Накладывает подпись на каждый кадр GIF, возвращает новый GIF"""
+    gif = Image.open(BytesIO(data))
+
+    frame_width, frame_height = gif.size
+
+    layout = layout_caption(text, frame_width, frame_height)
+
+    # Подпись растеризуется один раз и накладывается на каждый кадр;
+    # из одних пробелов строк не получится - кадры идут без подписи
+    masks = render_caption_masks(layout) if layout.lines else None
+    binary_masks = binarize_masks(masks) if masks else None
+
+    durations = []
+    frames = []
+
+    for frame in ImageSequence.Iterator(gif):
+        try:
+            durations.append(frame.info.get('duration', 50))
+        except:
+            durations.append(50)
+
+        frames.append(caption_frame(frame, masks, binary_masks))
+
+    output = BytesIO()
+    frames[0].save(
+        output,
+        format='GIF',
+        save_all=True,
+        append_images=frames[1:],
+        loop=0,
+        duration=durations,
+        optimize=False
+    )
+    return output.getvalue()
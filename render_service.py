@@ -0,0 +1,166 @@
+import multiprocessing
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, CancelledError, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+# ========== СЕРВИС РЕНДЕРА ==========
+# 0 - рендерить в потоке запроса, без отдельных процессов
+RENDER_PROCESSES = int(os.getenv('RENDER_PROCESSES', os.cpu_count() or 1))
+RENDER_QUEUE_SIZE = int(os.getenv('RENDER_QUEUE_SIZE', max(1, RENDER_PROCESSES) * 4))
+RENDER_QUEUE_WAIT = float(os.getenv('RENDER_QUEUE_WAIT', 2))
+RENDER_TIMEOUT = float(os.getenv('RENDER_TIMEOUT', 30))
+
+
+class RenderBusy(Exception):
+    """Очередь рендера заполнена"""
+
+    def __str__(self):
+        return "Сервер перегружен, попробуйте чуть позже"
+
+
+class RenderTimeout(Exception):
+    """Рендер не уложился в RENDER_TIMEOUT"""
+
+    def __str__(self):
+        return "Рендер занял слишком много времени"
+
+
+class RenderService:
+    """Рендер Pillow в отдельных процессах, чтобы тяжёлая GIF не держала GIL
+
+    Задачи - функции уровня модуля (render_jobs), аргументы и результат -
+    байты. Одновременно принимается не больше max_pending задач (в работе
+    и в очереди): остальные ждут место до queue_wait секунд и получают
+    RenderBusy. Не начатая к таймауту задача отменяется; уже идущую
+    отменить нельзя, поэтому пул пересоздаётся, а его процессы убиваются -
+    иначе зависший рендер держал бы процесс, и следующие задачи тоже
+    упирались бы в таймаут. Чужие задачи убитого пула один раз
+    перезапускаются в новом.
+
+    Процессы создаются fork'ом в start(), пока в приложении ещё нет
+    фоновых потоков; spawn и forkserver не годятся - они заново выполнили
+    бы bot.py в каждом процессе. Пересозданный после сбоя или таймаута пул
+    форкается уже из многопоточного процесса: если в этот момент другой
+    поток держал блокировку (stdout, logging), процесс рендера может
+    повиснуть на ней. Такой процесс упрётся в таймаут и будет пересоздан.
+    """
+
+    def __init__(self, processes=RENDER_PROCESSES, max_pending=RENDER_QUEUE_SIZE,
+                 queue_wait=RENDER_QUEUE_WAIT, timeout=RENDER_TIMEOUT):
+        self.processes = processes
+        self.max_pending = max_pending
+        self.queue_wait = queue_wait
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.failed = 0
+        self.restarts = 0
+        self.recycles = 0
+        # Пулы, которые мы убили сами: их задачи не виноваты и перезапускаются
+        self.recycled = weakref.WeakSet()
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context('fork')
+                )
+            return self.executor
+
+    def start(self):
+        """Запускает процессы заранее: при fork все воркеры создаются на первой задаче"""
+        if self.processes > 0:
+            self._executor().submit(int).result()
+
+    def _restart(self, broken):
+        with self.lock:
+            if self.executor is broken:
+                self.executor = None
+                self.restarts += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _recycle(self, executor):
+        """Рендер завис в процессе - убиваем процессы пула, следующая задача создаст новый"""
+        with self.lock:
+            self.recycled.add(executor)
+            if self.executor is executor:
+                self.executor = None
+                self.recycles += 1
+        # Публичного способа убить воркеры нет (до Python 3.14)
+        processes = list((getattr(executor, '_processes', None) or {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+
+    def _submit(self, func, args, timeout):
+        for attempt in range(2):
+            executor = self._executor()
+            try:
+                future = executor.submit(func, *args)
+            except RuntimeError:
+                # Соседний поток только что пересоздал пул - берём новый
+                if attempt:
+                    raise
+                continue
+            try:
+                return future.result(timeout=timeout)
+            except FutureTimeout:
+                # Ещё в очереди - снимаем; уже в работе - пересоздаём пул
+                if not future.cancel():
+                    self._recycle(executor)
+                with self.lock:
+                    self.timeouts += 1
+                raise RenderTimeout()
+            except (BrokenProcessPool, CancelledError):
+                if attempt or executor not in self.recycled:
+                    self._restart(executor)
+                    raise
+
+    def run(self, func, *args, timeout=None):
+        """Выполняет func(*args) в пуле и возвращает результат"""
+        if not self.slots.acquire(timeout=self.queue_wait):
+            with self.lock:
+                self.rejected += 1
+            raise RenderBusy()
+        with self.lock:
+            self.in_flight += 1
+        try:
+            if self.processes <= 0:
+                result = func(*args)
+            else:
+                result = self._submit(func, args, timeout or self.timeout)
+            with self.lock:
+                self.completed += 1
+            return result
+        except (RenderTimeout, RenderBusy):
+            raise
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            raise
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'processes': self.processes,
+                'in_flight': self.in_flight,
+                'max_pending': self.max_pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'failed': self.failed,
+                'restarts': self.restarts,
+                'recycles': self.recycles,
+            }
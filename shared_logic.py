@@ -3,12 +3,22 @@ import random
 import requests
 import json
 import time
-from PIL import Image, ImageDraw, ImageFont, ImageSequence
+from PIL import Image
 from io import BytesIO
 import re
 import hashlib
 from datetime import datetime, timedelta
 import pytz
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from http_client import http_get
+from harvester import ImageHarvester
+from provider_router import ProviderRouter
+from quotas import QuotaScheduler, QuotaExhausted, FallbackCache, QUOTA_RESERVE
+from image_cache import SourceImageCache, SOURCE_GIF_CACHE_BYTES
+from meme_sources import TemplateCatalog, MemePool
+from render_service import RenderService, RenderBusy
+import render_jobs
 
 # ========== ЗАГРУЗКА ЭМОДЗИ ==========
 def load_emojis():
@@ -64,18 +74,16 @@ MEME_QUERIES = [
 ]
 
 # ========== ИСТОЧНИКИ МЕМОВ ==========
-MEME_SOURCES = [
-    {
-        'name': 'reddit',
+MEME_SOURCES = {
+    'reddit': {
         'url': 'https://meme-api.com/gimme',
-        'parser': lambda data: (data.get('url'), data.get('preview', [data.get('url')])[-1] if data.get('preview') else data.get('url'))
+        'parser': lambda data: [(m.get('url'), m['preview'][-1] if m.get('preview') else m.get('url')) for m in data.get('memes', [])]
     },
-    {
-        'name': 'imgflip',
+    'imgflip': {
         'url': 'https://api.imgflip.com/get_memes',
-        'parser': lambda data: (random.choice(data['data']['memes'])['url'], None) if data.get('data') and data['data'].get('memes') else (None, None)
+        'parser': lambda data: [(m['url'], m['url']) for m in (data.get('data') or {}).get('memes', [])]
     }
-]
+}
 
 # ========== ЭМОДЗИ ДНЯ ==========
 EMOJI_PHRASES = [
@@ -168,81 +176,170 @@ def get_user_emoji(user_id):
     return new_emoji
 
 # ========== API ФУНКЦИИ ==========
+# Нет токена - запрос не отправлялся, это не сбой провайдера
+provider_router = ProviderRouter(skipped=(QuotaExhausted,))
+quota_scheduler = QuotaScheduler()
+# Последние удачные выдачи - отдаём их, когда квоты кончились
+recent_images = FallbackCache()
+recent_gifs = FallbackCache()
+
+def provider_get(provider, url, **kwargs):
+    """Запрос к API провайдера: берёт токен квоты, 429 сразу сообщаем маршрутизатору
+
+    429 и 5xx поднимаются как HTTPError - это сбой провайдера; остальные
+    ответы (в том числе пустая выдача или 404) возвращаются как есть.
+    """
+    if not quota_scheduler.try_acquire(provider):
+        raise QuotaExhausted(provider)
+    response = http_get(url, **kwargs)
+    quota_scheduler.update_from_headers(provider, response.headers)
+    if response.status_code == 429:
+        retry_after = response.headers.get('Retry-After')
+        quota_scheduler.exhaust(provider, float(retry_after) if retry_after and retry_after.isdigit() else None)
+        provider_router.note_rate_limited(provider)
+    if response.status_code == 429 or response.status_code >= 500:
+        response.raise_for_status()
+    return response
+
+def providers_with_quota(providers):
+    """Провайдеры, у которых ещё есть токены; остальных не трогаем до пополнения"""
+    return [p for p in providers if quota_scheduler.available(p)]
+
+# Пустая выдача - (None, None); таймауты, обрывы, 429 и 5xx пробрасываются
+# наружу, чтобы маршрутизатор засчитал их как сбой провайдера
 def get_unsplash_image(query):
     url = f'https://api.unsplash.com/photos/random?query={query}&client_id={UNSPLASH_ACCESS_KEY}'
-    try:
-        r = requests.get(url, timeout=10)
-        if r.status_code == 200:
-            data = r.json()
-            urls = data.get('urls', {})
-            return urls.get('regular'), urls.get('thumb')
-        return None, None
-    except:
-        return None, None
+    r = provider_get('unsplash', url, timeout=10)
+    # 404 у Unsplash - «нет фото по запросу»
+    if r.status_code == 200:
+        data = r.json()
+        urls = data.get('urls', {})
+        return urls.get('regular'), urls.get('thumb')
+    return None, None
 
 def get_pexels_image(query):
     url = f'https://api.pexels.com/v1/search?query={query}&per_page=1&page={random.randint(1, 100)}'
     headers = {'Authorization': PEXELS_API_KEY}
-    try:
-        r = requests.get(url, headers=headers, timeout=10)
-        if r.status_code == 200:
-            data = r.json()
-            photos = data.get('photos', [])
-            if photos:
-                photo = photos[0]
-                return photo['src']['large'], photo['src']['small']
-        return None, None
-    except:
-        return None, None
+    r = provider_get('pexels', url, headers=headers, timeout=10)
+    if r.status_code == 200:
+        data = r.json()
+        photos = data.get('photos', [])
+        if photos:
+            photo = photos[0]
+            return photo['src']['large'], photo['src']['small']
+    return None, None
 
 def get_pixabay_image(query):
     url = f'https://pixabay.com/api/?key={PIXABAY_API_KEY}&q={query}&image_type=photo&per_page=3&page={random.randint(1, 50)}'
-    try:
-        r = requests.get(url, timeout=10)
-        if r.status_code == 200:
-            data = r.json()
-            hits = data.get('hits', [])
-            if hits:
-                photo = random.choice(hits)
-                return photo['largeImageURL'], photo['previewURL']
-        return None, None
-    except:
-        return None, None
+    r = provider_get('pixabay', url, timeout=10)
+    if r.status_code == 200:
+        data = r.json()
+        hits = data.get('hits', [])
+        if hits:
+            photo = random.choice(hits)
+            return photo['largeImageURL'], photo['previewURL']
+    return None, None
+
+# ========== ПАКЕТНЫЕ ЗАПРОСЫ ДЛЯ ПУЛОВ ==========
+def get_unsplash_batch(query):
+    url = f'https://api.unsplash.com/photos/random?query={query}&count=30&client_id={UNSPLASH_ACCESS_KEY}'
+    r = provider_get('unsplash', url, timeout=10)
+    if r.status_code != 200:
+        return []
+    return [(p['urls'].get('regular'), p['urls'].get('thumb')) for p in r.json() if p.get('urls')]
+
+def get_pexels_batch(query):
+    url = f'https://api.pexels.com/v1/search?query={query}&per_page=80&page={random.randint(1, 5)}'
+    r = provider_get('pexels', url, headers={'Authorization': PEXELS_API_KEY}, timeout=10)
+    if r.status_code != 200:
+        return []
+    return [(p['src']['large'], p['src']['small']) for p in r.json().get('photos', [])]
+
+def get_pixabay_batch(query):
+    url = f'https://pixabay.com/api/?key={PIXABAY_API_KEY}&q={query}&image_type=photo&per_page=200&page={random.randint(1, 2)}'
+    r = provider_get('pixabay', url, timeout=10)
+    if r.status_code != 200:
+        return []
+    return [(p['largeImageURL'], p['previewURL']) for p in r.json().get('hits', [])]
+
+IMAGE_FETCHERS = {
+    'unsplash': get_unsplash_image,
+    'pexels': get_pexels_image,
+    'pixabay': get_pixabay_image,
+}
+
+BATCH_FETCHERS = {
+    'unsplash': get_unsplash_batch,
+    'pexels': get_pexels_batch,
+    'pixabay': get_pixabay_batch,
+}
+
+image_harvester = ImageHarvester(
+    {api: BATCH_FETCHERS[api] for api in available_apis},
+    popular=RANDOM_QUERIES,
+    # Фоновый сбор откладывается, пока у провайдера нет запаса сверх резерва живых запросов
+    available=lambda api: provider_router.is_available(api) and quota_scheduler.available(api, reserve=QUOTA_RESERVE)
+)
 
 def get_random_image(custom_query=None):
     query = custom_query or random.choice(RANDOM_QUERIES)
-    for api in available_apis:
-        if api == 'unsplash':
-            image_url, thumb_url = get_unsplash_image(query)
-        elif api == 'pexels':
-            image_url, thumb_url = get_pexels_image(query)
-        elif api == 'pixabay':
-            image_url, thumb_url = get_pixabay_image(query)
+    
+    # Сначала пул, собранный фоном; промах - живой запрос как раньше
+    harvested = image_harvester.take(query)
+    if harvested:
+        recent_images.remember(query, harvested)
+        return harvested
+    
+    # Провайдеры по здоровью; медленный ответ дублируется следующему
+    def fetch(api):
+        image_url, thumb_url = IMAGE_FETCHERS[api](query)
         if image_url and thumb_url:
             return image_url, thumb_url
+        return None
+    
+    providers = provider_router.order(providers_with_quota(available_apis))
+    if providers:
+        result = provider_router.call(providers, fetch)
+        if result:
+            recent_images.remember(query, result)
+            return result
+        # Провайдеры ответили, но ничего не нашли - честно отдаём пустоту
+        return None, None
+    
+    # Живой запрос не отправлялся: квоты кончились или автоматы открыты - повторяем
+    # недавнюю выдачу по этому запросу (для случайного - по любому)
+    fallback = recent_images.recall(query, any_key=custom_query is None)
+    if fallback:
+        print(f"♻️ Отдаём картинку из недавних для '{query}'")
+        return fallback
     return None, None
 
+def load_meme_source(name, url):
+    response = http_get(url, timeout=10)
+    response.raise_for_status()
+    return MEME_SOURCES[name]['parser'](response.json())
+
+def get_reddit_meme_batch(subreddit, count):
+    """Одним запросом до count мемов: meme-api отдаёт их пачкой"""
+    base = MEME_SOURCES['reddit']['url']
+    url = f"{base}/{subreddit}/{count}" if subreddit else f"{base}/{count}"
+    return load_meme_source('reddit', url)
+
+meme_templates = TemplateCatalog(lambda: load_meme_source('imgflip', MEME_SOURCES['imgflip']['url']))
+reddit_memes = MemePool(get_reddit_meme_batch)
+
 def get_random_meme(query=None):
-    sources = MEME_SOURCES.copy()
+    sources = list(MEME_SOURCES)
     random.shuffle(sources)
     
     for source in sources:
-        try:
-            if source['name'] == 'reddit' and query:
-                url = f"https://meme-api.com/gimme/{query}"
-            else:
-                url = source['url']
-            
-            response = requests.get(url, timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                meme_url, thumb_url = source['parser'](data)
-                if meme_url:
-                    if not thumb_url:
-                        thumb_url = meme_url
-                    return meme_url, thumb_url
-        except:
-            continue
+        # Шаблоны imgflip и пачки meme-api лежат в памяти - к API ходим только за пополнением
+        if source == 'reddit':
+            meme = reddit_memes.take(query or '')
+        else:
+            meme = meme_templates.random()
+        if meme:
+            return meme
     
     tag = query or random.choice(MEME_QUERIES)
     return get_random_image(tag)
@@ -253,9 +350,24 @@ def get_random_gif(query=None):
         print("❌ GIPHY API ключ не настроен")
         return None
     
+    tag = query or random.choice(RANDOM_QUERIES)
+    # Через маршрутизатор: при открытом автомате не ждём таймаут GIPHY
+    providers = provider_router.order(providers_with_quota(['giphy']))
+    if providers:
+        gif_url = provider_router.call(providers, lambda _: fetch_giphy_gif(tag))
+        if gif_url:
+            recent_gifs.remember(tag, gif_url)
+        return gif_url
+    
+    # Квота GIPHY кончилась или автомат открыт
+    fallback = recent_gifs.recall(tag, any_key=query is None)
+    if fallback:
+        print(f"♻️ GIPHY недоступен, отдаём недавнюю GIF для '{tag}'")
+    return fallback
+
+def fetch_giphy_gif(tag):
+    """GIF по тегу или None; сбои (таймаут, обрыв, 429, 5xx) пробрасываются маршрутизатору"""
     try:
-        tag = query or random.choice(RANDOM_QUERIES)
-        
         url = "https://api.giphy.com/v1/gifs/random"
         params = {
             'api_key': GIPHY_API_KEY,
@@ -265,7 +377,7 @@ def get_random_gif(query=None):
         }
         
         print(f"🔄 GIPHY: запрос с тегом '{tag}'")
-        response = requests.get(url, params=params, timeout=10)
+        response = provider_get('giphy', url, params=params, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -277,8 +389,6 @@ def get_random_gif(query=None):
             else:
                 print(f"⚠️ GIPHY meta error: {data.get('meta')}")
         
-        elif response.status_code == 429:
-            print("❌ GIPHY: Лимит запросов исчерпан (429)")
         elif response.status_code == 403:
             print("❌ GIPHY: Ошибка авторизации (403)")
         else:
@@ -286,19 +396,27 @@ def get_random_gif(query=None):
         
         return None
         
+    except QuotaExhausted:
+        raise
     except requests.exceptions.Timeout:
         print("❌ GIPHY: Таймаут")
-        return None
+        raise
     except requests.exceptions.ConnectionError:
         print("❌ GIPHY: Ошибка соединения")
-        return None
+        raise
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 429:
+            print("❌ GIPHY: Лимит запросов исчерпан (429)")
+        else:
+            print(f"❌ GIPHY: {e}")
+        raise
     except Exception as e:
         print(f"❌ GIPHY ошибка: {e}")
         return None
 
 def get_russian_phrase():
     try:
-        response = requests.get(
+        response = http_get(
             'https://fucking-great-advice.ru/api/random',
             timeout=5,
             headers={'User-Agent': 'Mozilla/5.0'}
@@ -322,210 +440,157 @@ def get_random_phrase(category="random"):
         return random.choice(PHRASES[category])
     return "Случайная фраза"
 
-# ========== ФУНКЦИИ ДОБАВЛЕНИЯ ТЕКСТА ==========
-def add_text_to_image(image_url, text):
+# ========== ПАРАЛЛЕЛЬНЫЙ ПОИСК ==========
+FETCH_WORKERS = max(1, int(os.getenv('FETCH_WORKERS', 4)))
+
+def fetch_unique(fetch_func, count, max_attempts=None, key=None, workers=None, cancelled=None):
+    """Параллельно вызывает fetch_func, пока не наберётся count уникальных результатов
+
+    key(result) возвращает ключ для дедупликации (обычно URL) или None,
+    если результат не подходит. Ждём только нужное количество: как только
+    уникальных результатов хватает, оставшиеся запросы отбрасываются.
+    Если cancelled() стал истинным, новых запросов не запускаем и
+    возвращаем то, что уже успели собрать.
+    """
+    if count <= 0:
+        return []
+    key = key or (lambda result: result)
+    max_attempts = max_attempts or count * 5
+    width = max(1, min(workers or FETCH_WORKERS, max_attempts))
+
+    results = []
+    seen = set()
+    attempts = 0
+    pending = set()
+    executor = ThreadPoolExecutor(max_workers=width)
     try:
-        r = requests.get(image_url, timeout=10)
-        img = Image.open(BytesIO(r.content)).convert('RGB')
-        
-        max_size = 1200
-        if img.width > max_size or img.height > max_size:
-            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-        
-        draw = ImageDraw.Draw(img)
-        
-        font_paths = [
-            '/app/fonts/Impact.ttf',
-            '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
-        ]
-        
-        base_font = None
-        for font_path in font_paths:
-            try:
-                base_font = ImageFont.truetype(font_path, 100)
+        while len(results) < count:
+            if cancelled and cancelled():
                 break
-            except:
-                pass
-        
-        if base_font is None:
-            base_font = ImageFont.load_default()
-        
-        side_margin = min(max(int(img.width * 0.05), 20), 60)
-        target_width = img.width - (side_margin * 2)
-        safety_margin = 0.93
-        
-        unique_chars = ''.join(set(text.replace(' ', ''))) or "А"
-        char_width_target = (target_width / len(text)) * safety_margin
-        
-        test_sizes = [200, 180, 160, 140, 120, 110, 100, 95, 90, 85, 80, 75, 70, 68, 66, 64, 62, 60, 58, 56, 54, 52, 50, 48, 46, 44, 42, 40, 38, 36, 34, 32, 30, 28, 26, 24, 22, 20]
-        
-        optimal_font_size = 20
-        for size in test_sizes:
-            font = base_font.font_variant(size=size)
-            total_width = 0
-            for char in unique_chars[:5]:
-                bbox = draw.textbbox((0, 0), char, font=font)
-                total_width += bbox[2] - bbox[0]
-            avg_char_width = total_width / min(len(unique_chars), 5)
-            if avg_char_width <= char_width_target:
-                optimal_font_size = size
+            # Держим в полёте не больше, чем ещё нужно результатов
+            while attempts < max_attempts and len(pending) < min(width, count - len(results)):
+                pending.add(executor.submit(fetch_func))
+                attempts += 1
+            if not pending:
                 break
-        
-        font = base_font.font_variant(size=optimal_font_size)
-        
-        words = text.split()
-        lines = []
-        current_line = []
-        
-        for word in words:
-            test_line = ' '.join(current_line + [word])
-            bbox = draw.textbbox((0, 0), test_line, font=font)
-            if bbox[2] - bbox[0] <= target_width:
-                current_line.append(word)
-            else:
-                if current_line:
-                    lines.append(' '.join(current_line))
-                current_line = [word]
-        
-        if current_line:
-            lines.append(' '.join(current_line))
-        
-        y_offset = img.height - 60
-        outline_range = max(2, int(optimal_font_size * 0.03))
-        
-        for line in reversed(lines):
-            bbox = draw.textbbox((0, 0), line, font=font)
-            tw = bbox[2] - bbox[0]
-            th = bbox[3] - bbox[1]
-            x = (img.width - tw) // 2
-            y = y_offset - th
-            
-            for dx in range(-outline_range, outline_range + 1):
-                for dy in range(-outline_range, outline_range + 1):
-                    if dx != 0 or dy != 0:
-                        draw.text((x + dx, y + dy), line, font=font, fill='black')
-            
-            draw.text((x, y), line, font=font, fill='white')
-            y_offset = y - int(optimal_font_size * 0.2)
-        
-        full_output = BytesIO()
-        img.save(full_output, format='JPEG', quality=90, optimize=True)
-        full_output.seek(0)
-        
-        return full_output
+
+            done, pending = wait(pending, timeout=0.1 if cancelled else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                    result_key = key(result) if result else None
+                except Exception:
+                    continue
+                if result_key and result_key not in seen and len(results) < count:
+                    seen.add(result_key)
+                    results.append(result)
+    finally:
+        # Не ждём зависшие запросы - их результаты уже не нужны
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+# ========== ФУНКЦИИ ДОБАВЛЕНИЯ ТЕКСТА ==========
+# Повышать при любом изменении вида рендера - от версии зависят id готовых картинок
+RENDERER_VERSION = 4
+# Наибольшая сторона картинки, на которую накладывается текст
+RENDER_MAX_SIZE = 1200
+MAX_SOURCE_PIXELS = int(os.getenv('MAX_SOURCE_PIXELS', 50_000_000))
+MAX_SOURCE_BYTES = int(os.getenv('MAX_SOURCE_MB', 20)) * 1024 * 1024
+# Сумма пикселей всех кадров GIF: каждый кадр декодируется в процессе рендера
+MAX_GIF_PIXELS = int(os.getenv('MAX_GIF_PIXELS', 200_000_000))
+# Наибольшая сторона превьюшки для выбора в inline
+THUMB_SIZE = int(os.getenv('THUMB_SIZE', 320))
+
+def decode_source_image(data, max_size=RENDER_MAX_SIZE, max_pixels=MAX_SOURCE_PIXELS):
+    """Декодирует исходник сразу в уменьшенном виде: не больше max_size по большей стороне"""
+    img = Image.open(BytesIO(data))
+    # Размер известен из заголовка - огромные картинки отсекаем до декодирования
+    if img.width * img.height > max_pixels:
+        raise ValueError(f"Слишком большая картинка: {img.width}x{img.height}")
+    
+    # JPEG декодируется сразу в масштабе 1/2, 1/4 или 1/8 - не меньше итогового размера
+    scale = min(1.0, max_size / max(img.width, img.height))
+    img.draft('RGB', (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    
+    # thumbnail сначала грубо ужимает через reduce(), потом доводит LANCZOS
+    if img.width > max_size or img.height > max_size:
+        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    else:
+        img.load()
+    return img
+
+def download_limited(url, max_bytes=MAX_SOURCE_BYTES):
+    """Скачивает файл по частям и обрывает загрузку, как только он больше max_bytes"""
+    r = http_get(url, timeout=10, stream=True)
+    try:
+        r.raise_for_status()
+        if int(r.headers.get('Content-Length') or 0) > max_bytes:
+            raise ValueError(f"Слишком большой файл: {r.headers.get('Content-Length')} байт")
+        # Content-Length может не быть (chunked) - считаем сами
+        data = bytearray()
+        for chunk in r.iter_content(chunk_size=64 * 1024):
+            data.extend(chunk)
+            if len(data) > max_bytes:
+                raise ValueError(f"Слишком большой файл: больше {max_bytes} байт")
+        return bytes(data)
+    finally:
+        r.close()
+
+def load_source_image(image_url):
+    """Скачивает и декодирует исходник, сразу уменьшая его до рабочего размера"""
+    return decode_source_image(download_limited(image_url))
+
+def check_source_gif(data, max_pixels=MAX_SOURCE_PIXELS, max_total_pixels=MAX_GIF_PIXELS):
+    """Отсекает GIF-бомбы по заголовку: огромный холст или слишком много кадров"""
+    gif = Image.open(BytesIO(data))
+    if gif.width * gif.height > max_pixels:
+        raise ValueError(f"Слишком большая GIF: {gif.width}x{gif.height}")
+    # n_frames только перебирает заголовки кадров, без декодирования
+    frames = getattr(gif, 'n_frames', 1)
+    if gif.width * gif.height * frames > max_total_pixels:
+        raise ValueError(f"Слишком большая GIF: {gif.width}x{gif.height}, {frames} кадров")
+    return data
+
+def load_source_gif(gif_url):
+    return check_source_gif(download_limited(gif_url))
+
+source_images = SourceImageCache(load_source_image)
+# GIF держим сырыми байтами: из них делаются и подписанная GIF, и превьюшка
+source_gifs = SourceImageCache(load_source_gif, max_bytes=SOURCE_GIF_CACHE_BYTES, sizer=len)
+render_service = RenderService()
+
+def add_text_to_image(image_url, text):
+    try:
+        # Декодированный исходник берём из кеша, в процесс рендера уходят его пиксели
+        img = source_images.get(image_url)
+        data = render_service.run(render_jobs.caption_image, img.mode, img.size, img.tobytes(), text)
+        return BytesIO(data)
+    except RenderBusy:
+        raise
     except:
         return None
 
 def add_text_to_gif(gif_url, text):
     try:
-        r = requests.get(gif_url, timeout=10)
-        gif = Image.open(BytesIO(r.content))
-        
-        first_frame = gif.convert('RGB')
-        frame_width, frame_height = first_frame.size
-        
-        font_paths = [
-            '/app/fonts/Impact.ttf',
-            '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
-        ]
-        
-        base_font = None
-        for font_path in font_paths:
-            try:
-                base_font = ImageFont.truetype(font_path, 100)
-                break
-            except:
-                pass
-        
-        if base_font is None:
-            base_font = ImageFont.load_default()
-        
-        side_margin = min(max(int(frame_width * 0.05), 20), 60)
-        target_width = frame_width - (side_margin * 2)
-        safety_margin = 0.93
-        
-        unique_chars = ''.join(set(text.replace(' ', ''))) or "А"
-        char_width_target = (target_width / len(text)) * safety_margin
-        
-        test_sizes = [200, 180, 160, 140, 120, 110, 100, 95, 90, 85, 80, 75, 70, 68, 66, 64, 62, 60, 58, 56, 54, 52, 50, 48, 46, 44, 42, 40, 38, 36, 34, 32, 30, 28, 26, 24, 22, 20]
-        
-        optimal_font_size = 20
-        temp_draw = ImageDraw.Draw(first_frame)
-        
-        for size in test_sizes:
-            font = base_font.font_variant(size=size)
-            total_width = 0
-            for char in unique_chars[:5]:
-                bbox = temp_draw.textbbox((0, 0), char, font=font)
-                total_width += bbox[2] - bbox[0]
-            avg_char_width = total_width / min(len(unique_chars), 5)
-            if avg_char_width <= char_width_target:
-                optimal_font_size = size
-                break
-        
-        font = base_font.font_variant(size=optimal_font_size)
-        
-        words = text.split()
-        lines = []
-        current_line = []
-        
-        for word in words:
-            test_line = ' '.join(current_line + [word])
-            bbox = temp_draw.textbbox((0, 0), test_line, font=font)
-            if bbox[2] - bbox[0] <= target_width:
-                current_line.append(word)
-            else:
-                if current_line:
-                    lines.append(' '.join(current_line))
-                current_line = [word]
-        
-        if current_line:
-            lines.append(' '.join(current_line))
-        
-        durations = []
-        frames = []
-        
-        for frame in ImageSequence.Iterator(gif):
-            try:
-                durations.append(frame.info.get('duration', 50))
-            except:
-                durations.append(50)
-            
-            frame_rgb = frame.convert('RGB')
-            frame_copy = frame_rgb.copy()
-            draw = ImageDraw.Draw(frame_copy)
-            
-            y_offset = frame_copy.height - 60
-            outline_range = max(2, int(optimal_font_size * 0.03))
-            
-            for line in reversed(lines):
-                bbox = draw.textbbox((0, 0), line, font=font)
-                tw = bbox[2] - bbox[0]
-                th = bbox[3] - bbox[1]
-                x = (frame_copy.width - tw) // 2
-                y = y_offset - th
-                
-                for dx in range(-outline_range, outline_range + 1):
-                    for dy in range(-outline_range, outline_range + 1):
-                        if dx != 0 or dy != 0:
-                            draw.text((x + dx, y + dy), line, font=font, fill='black')
-                
-                draw.text((x, y), line, font=font, fill='white')
-                y_offset = y - int(optimal_font_size * 0.2)
-            
-            frames.append(frame_copy)
-        
-        output = BytesIO()
-        frames[0].save(
-            output,
-            format='GIF',
-            save_all=True,
-            append_images=frames[1:],
-            loop=0,
-            duration=durations,
-            optimize=False
-        )
-        output.seek(0)
-        return output
+        data = render_service.run(render_jobs.caption_gif, source_gifs.get(gif_url), text)
+        return BytesIO(data)
+    except RenderBusy:
+        raise
+    except:
+        return None
+
+def make_thumbnail(kind, source_url, text):
+    """JPEG-превьюшка рендера: для картинки - из кешированных пикселей, для GIF - первый кадр"""
+    try:
+        if kind == 'gif':
+            data = render_service.run(render_jobs.gif_thumbnail, source_gifs.get(source_url), text, THUMB_SIZE)
+        else:
+            img = source_images.get(source_url)
+            data = render_service.run(render_jobs.caption_thumbnail, img.mode, img.size, img.tobytes(), text, THUMB_SIZE)
+        return BytesIO(data)
+    except RenderBusy:
+        raise
     except:
         return None
\ No newline at end of file
@@ -0,0 +1,206 @@
+from collections import namedtuple
+
+from PIL import Image, ImageChops, ImageColor, ImageDraw
+
+from fonts import get_font, text_advance, text_bbox, text_width
+
+# ========== РАСКЛАДКА ПОДПИСИ ==========
+CAPTION_SIZES = [200, 180, 160, 140, 120, 110, 100, 95, 90, 85, 80, 75, 70, 68, 66, 64, 62, 60, 58, 56, 54, 52, 50, 48, 46, 44, 42, 40, 38, 36, 34, 32, 30, 28, 26, 24, 22, 20]
+REFERENCE_SIZE = 100
+SAFETY_MARGIN = 0.93
+BOTTOM_MARGIN = 60
+SAMPLE_CHARS = 5
+
+CaptionLayout = namedtuple('CaptionLayout', ['font_size', 'lines', 'boxes'])
+CaptionMasks = namedtuple('CaptionMasks', ['x', 'y', 'fill', 'outline'])
+
+
+def _avg_char_width(size, sample):
+    return sum(text_width(size, char) for char in sample) / len(sample)
+
+
+def pick_font_size(text, target_width):
+    """Самый крупный размер из CAPTION_SIZES, при котором средний символ влезает в строку
+
+    Ширина глифов растёт почти линейно с размером, поэтому размер
+    оценивается по одному замеру на REFERENCE_SIZE, а затем уточняется
+    соседними шагами по списку.
+    """
+    # dict.fromkeys сохраняет порядок - выборка символов детерминирована
+    sample = ''.join(dict.fromkeys(text.replace(' ', '')))[:SAMPLE_CHARS] or "А"
+    char_width_target = (target_width / max(len(text), 1)) * SAFETY_MARGIN
+
+    def fits(index):
+        return _avg_char_width(CAPTION_SIZES[index], sample) <= char_width_target
+
+    reference_width = _avg_char_width(REFERENCE_SIZE, sample)
+    estimate = REFERENCE_SIZE * char_width_target / reference_width if reference_width else CAPTION_SIZES[0]
+
+    last = len(CAPTION_SIZES) - 1
+    index = next((i for i, size in enumerate(CAPTION_SIZES) if size <= estimate), last)
+    while index < last and not fits(index):
+        index += 1
+    while index > 0 and fits(index - 1):
+        index -= 1
+    return CAPTION_SIZES[index]
+
+
+def wrap_words(text, size, target_width):
+    """Разбивает текст на строки по закэшированной ширине слов"""
+    space = text_advance(size, ' ')
+    lines = []
+    current_line = []
+    current_width = 0
+
+    for word in text.split():
+        word_width = text_advance(size, word)
+        new_width = current_width + space + word_width if current_line else word_width
+        if new_width <= target_width or not current_line:
+            current_line.append(word)
+            current_width = new_width
+        else:
+            lines.append(' '.join(current_line))
+            current_line = [word]
+            current_width = word_width
+
+    if current_line:
+        lines.append(' '.join(current_line))
+    return lines
+
+
+def layout_caption(text, width, height):
+    """Возвращает размер шрифта, строки и их рамки (x, y, w, h) для подписи внизу кадра"""
+    side_margin = min(max(int(width * 0.05), 20), 60)
+    target_width = width - (side_margin * 2)
+
+    font_size = pick_font_size(text, target_width)
+    lines = wrap_words(text, font_size, target_width)
+
+    boxes = []
+    y_offset = height - BOTTOM_MARGIN
+    for line in reversed(lines):
+        bbox = text_bbox(font_size, line)
+        tw = bbox[2] - bbox[0]
+        th = bbox[3] - bbox[1]
+        x = (width - tw) // 2
+        y = y_offset - th
+        boxes.append((x, y, tw, th))
+        y_offset = y - int(font_size * 0.2)
+    boxes.reverse()
+
+    return CaptionLayout(font_size, lines, boxes)
+
+
+# ========== ОТРИСОВКА ПОДПИСИ ==========
+def outline_width(font_size):
+    return max(2, int(font_size * 0.03))
+
+
+def _shift(mask, dx, dy):
+    return mask.transform(mask.size, Image.Transform.AFFINE, (1, 0, -dx, 0, 1, -dy))
+
+
+def dilate_mask(mask, radius):
+    """Квадратное расширение маски на radius пикселей
+
+    Эквивалентно MaxFilter(2 * radius + 1), но раскладывается по осям и
+    удваивает шаг, поэтому проходов O(log radius) вместо (2r+1)^2 отрисовок.
+    """
+    for axis in (0, 1):
+        done = 0
+        step = 1
+        while done < radius:
+            shift = min(step, radius - done)
+            dx, dy = (shift, 0) if axis == 0 else (0, shift)
+            shifted = ImageChops.lighter(_shift(mask, dx, dy), _shift(mask, -dx, -dy))
+            mask = ImageChops.lighter(mask, shifted)
+            done += shift
+            step *= 2
+    return mask
+
+
+def render_caption_masks(layout):
+    """Растеризует подпись один раз: маски заливки и обводки и их положение в кадре"""
+    radius = outline_width(layout.font_size)
+    font = get_font(layout.font_size)
+
+    inks = []
+    for line, (x, y, tw, th) in zip(layout.lines, layout.boxes):
+        bbox = text_bbox(layout.font_size, line)
+        inks.append((x + bbox[0], y + bbox[1], x + bbox[0] + tw, y + bbox[1] + th))
+
+    left = min(ink[0] for ink in inks) - radius
+    top = min(ink[1] for ink in inks) - radius
+    right = max(ink[2] for ink in inks) + radius
+    bottom = max(ink[3] for ink in inks) + radius
+
+    fill = Image.new('L', (right - left, bottom - top), 0)
+    draw = ImageDraw.Draw(fill)
+    for line, (x, y, tw, th) in zip(layout.lines, layout.boxes):
+        draw.text((x - left, y - top), line, font=font, fill=255)
+
+    return CaptionMasks(left, top, fill, dilate_mask(fill, radius))
+
+
+def paste_caption(img, masks, fill_color='white', outline_color='black'):
+    """Накладывает готовые маски подписи на кадр"""
+    box = (masks.x, masks.y, masks.x + masks.fill.width, masks.y + masks.fill.height)
+    img.paste(ImageColor.getcolor(outline_color, img.mode), box, masks.outline)
+    img.paste(ImageColor.getcolor(fill_color, img.mode), box, masks.fill)
+
+
+def draw_caption(img, layout):
+    """Рисует подпись с обводкой за одну растеризацию текста"""
+    if layout.lines:
+        paste_caption(img, render_caption_masks(layout))
+
+
+# ========== ПОДПИСЬ НА КАДРАХ GIF ==========
+def binarize_masks(masks):
+    """Жёсткие маски 0/255 для палитровых кадров, где цвета нельзя смешивать"""
+    def to_binary(mask):
+        return mask.point(lambda v: 255 if v >= 128 else 0)
+    return CaptionMasks(masks.x, masks.y, to_binary(masks.fill), to_binary(masks.outline))
+
+
+def _caption_palette(frame, colors):
+    """Индексы цветов подписи в палитре кадра (недостающие дописываются в свободные слоты)"""
+    palette = frame.getpalette() or []
+    transparency = frame.info.get('transparency')
+    indices = []
+    for color in colors:
+        index = None
+        for i in range(len(palette) // 3):
+            if i != transparency and tuple(palette[i * 3:i * 3 + 3]) == color:
+                index = i
+                break
+        if index is None:
+            if len(palette) // 3 >= 256:
+                return None
+            palette.extend(color)
+            index = len(palette) // 3 - 1
+        indices.append(index)
+    return indices, palette
+
+
+def caption_frame(frame, masks, binary_masks):
+    """Кадр GIF с подписью; палитровые кадры остаются в режиме P
+
+    masks None - подписи нет, кадр возвращается копией как есть.
+    """
+    if masks is None:
+        return frame.copy()
+    if frame.mode == 'P':
+        prepared = _caption_palette(frame, [(0, 0, 0), (255, 255, 255)])
+        if prepared:
+            (outline_index, fill_index), palette = prepared
+            out = frame.copy()
+            out.putpalette(palette)
+            box = (masks.x, masks.y, masks.x + masks.fill.width, masks.y + masks.fill.height)
+            out.paste(outline_index, box, binary_masks.outline)
+            out.paste(fill_index, box, binary_masks.fill)
+            return out
+
+    out = frame.convert('RGB') if frame.mode != 'RGB' else frame.copy()
+    paste_caption(out, masks)
+    return out
@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+from collections import deque
+
+# ========== ОЧЕРЕДЬ ОБНОВЛЕНИЙ ==========
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 8))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 1000))
+WAIT_WINDOW = 200
+
+
+class KeyedWorkQueue:
+    """Ограниченная очередь с пулом воркеров и порядком внутри ключа
+
+    Элементы одного ключа (пользователь или чат) обрабатываются строго по
+    очереди, разные ключи - параллельно. Ключ с накопившейся очередью
+    после каждого элемента уходит в конец, чтобы не держать воркер.
+    """
+
+    def __init__(self, handler, workers=UPDATE_WORKERS, max_pending=UPDATE_QUEUE_SIZE):
+        self.handler = handler
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queues = {}
+        self.ready = deque()
+        self.active = set()
+        self.cond = threading.Condition()
+        self.pending = 0
+        self.waits = deque(maxlen=WAIT_WINDOW)
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"update-worker-{i}", daemon=True).start()
+
+    def submit(self, key, item):
+        """Ставит элемент в очередь; False, если очередь переполнена"""
+        with self.cond:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            queue = self.queues.setdefault(key, deque())
+            queue.append((time.monotonic(), item))
+            self.pending += 1
+            if key not in self.active and len(queue) == 1:
+                self.ready.append(key)
+                self.cond.notify()
+        return True
+
+    def _next(self):
+        with self.cond:
+            while not self.ready:
+                self.cond.wait()
+            key = self.ready.popleft()
+            self.active.add(key)
+            enqueued, item = self.queues[key].popleft()
+            self.waits.append(time.monotonic() - enqueued)
+            return key, item
+
+    def _done(self, key):
+        with self.cond:
+            self.active.discard(key)
+            self.pending -= 1
+            self.processed += 1
+            if self.queues[key]:
+                self.ready.append(key)
+                self.cond.notify()
+            else:
+                del self.queues[key]
+
+    def _worker(self):
+        while True:
+            key, item = self._next()
+            try:
+                self.handler(item)
+            except Exception as e:
+                self.failed += 1
+                print(f"❌ Ошибка обработки обновления: {e}")
+            finally:
+                self._done(key)
+
+    def stats(self):
+        with self.cond:
+            waits = sorted(self.waits)
+            return {
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'keys': len(self.queues),
+                'in_flight': len(self.active),
+                'workers': self.workers,
+                'processed': self.processed,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'wait_avg_ms': round(sum(waits) / len(waits) * 1000, 1) if waits else None,
+                'wait_p95_ms': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else None,
+            }